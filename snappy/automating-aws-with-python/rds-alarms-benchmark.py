@@ -0,0 +1,421 @@
+# Offline scale benchmark for rds-alarms.py.
+#
+# Generates a synthetic RDS fleet spread over many accounts and regions and runs lambda_handler against it
+# without touching AWS. Real botocore clients are used, so parameter validation, paginators and the
+# rate limiting / retry hooks all run as they would in Lambda. Every attempt is answered at before-send,
+# where the HTTP request would go out, after an injected latency. The answer is a real HTTP response in the
+# service's protocol, so botocore parses it and needs-retry sees it. --throttle-rate answers that share of
+# attempts with a Throttling error, so the retries and the rate limiters' backing off are measured too.
+# A successful response is sent back empty, and after-call fills in the parsed result from memory.
+# Stubber's fixed queue of expected calls can't serve thousands of paginated calls from concurrent workers,
+# so the fake answers whatever is asked.
+#
+# Each scenario runs in a fresh process so the module level caches start cold and peak memory is per scenario.
+#
+#   python rds-alarms-benchmark.py --sizes 100,1000,10000,50000 --accounts 20 --regions 4 --latency-ms 5
+import argparse
+import importlib.util
+import json
+import os
+import random
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import botocore.session
+from botocore.awsrequest import AWSResponse
+
+RDS_ALARMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rds-alarms.py')
+
+ROLE_NAME = "AWS-RdsAlarmAutomation"
+SNS_NAME = "cloud-infrastructure-critical-rds"
+
+ALL_REGIONS = ('ap-southeast-2', 'ap-southeast-1', 'us-east-1', 'us-west-2', 'eu-west-1', 'eu-central-1',
+               'ap-northeast-1', 'ca-central-1', 'eu-west-2', 'sa-east-1', 'us-east-2', 'ap-south-1')
+
+ENGINES = ('mysql', 'postgres', 'oracle-ee', 'sqlserver-se', 'aurora-mysql', 'aurora-postgresql')
+
+ALARM_CONFIG = {
+    "liveCpuAlarm": {"threshold": "85", "comparison_operator": "GreaterThanThreshold",
+                     "datapoints_to_alarm": "2", "evaluation_period": "3"},
+    "testCpuAlarm": {"threshold": "90", "comparison_operator": "GreaterThanThreshold",
+                     "datapoints_to_alarm": "3", "evaluation_period": "5"},
+    "liveStorageAlarm": {"threshold": "20", "comparison_operator": "LessThanOrEqualToThreshold",
+                         "datapoints_to_alarm": "1", "evaluation_period": "1"},
+    "testStorageAlarm": {"threshold": "10", "comparison_operator": "LessThanOrEqualToThreshold",
+                         "datapoints_to_alarm": "1", "evaluation_period": "1"},
+    "liveQueueLengthAlarm": {"comparison_operator": "GreaterThanOrEqualToThreshold",
+                             "datapoints_to_alarm": "2", "evaluation_period": "3"},
+    "testQueueLengthAlarm": {"comparison_operator": "GreaterThanOrEqualToThreshold",
+                             "datapoints_to_alarm": "3", "evaluation_period": "5"}
+}
+
+
+def load_rds_alarms():
+    spec = importlib.util.spec_from_file_location('rds_alarms', RDS_ALARMS_PATH)
+    rds_alarms = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(rds_alarms)
+
+    return rds_alarms
+
+
+# A synthetic fleet: instance_count DB instances spread evenly over every (account, region) pair.
+# aurora_ratio of them are Aurora (CPU alarm only) and tagged_ratio have an Environment tag, half of those live.
+# Accounts listed in no_tag_list_accounts don't get a TagList from describe_db_instances, so the
+# Resource Groups Tagging API path is exercised too.
+def generate_fleet(instance_count, accounts, regions, aurora_ratio=0.3, tagged_ratio=0.8, no_tag_list_ratio=0.25,
+                   seed=42):
+    randomiser = random.Random(seed)
+    pairs = [(account_id, region) for account_id in accounts for region in regions]
+    fleet = {pair: [] for pair in pairs}
+    no_tag_list_accounts = set(accounts[:int(len(accounts) * no_tag_list_ratio)])
+
+    for number in range(instance_count):
+        account_id, region = pairs[number % len(pairs)]
+
+        if randomiser.random() < aurora_ratio:
+            engine = randomiser.choice(ENGINES[4:])
+        else:
+            engine = randomiser.choice(ENGINES[:4])
+
+        tags = []
+        if randomiser.random() < tagged_ratio:
+            tags.append({'Key': 'Environment', 'Value': randomiser.choice(('Live', 'LiveB', 'Test', 'Dev'))})
+            tags.append({'Key': 'Project', 'Value': 'project-{0}'.format(number % 50)})
+
+        identifier = "db-{0:06d}".format(number)
+        fleet[(account_id, region)].append({
+            'DBInstanceIdentifier': identifier,
+            'DBInstanceArn': "arn:aws:rds:{0}:{1}:db:{2}".format(region, account_id, identifier),
+            'Engine': engine,
+            'AllocatedStorage': randomiser.choice((20, 100, 500, 1000, 2000)),
+            'TagList': tags,
+            'HasTagList': account_id not in no_tag_list_accounts
+        })
+
+    return fleet
+
+
+# In-memory RDS, CloudWatch, Resource Groups Tagging and STS for the fleet, answering with an injected latency.
+class FakeAws:
+
+    def __init__(self, fleet, latency, throttle_rate=0.0, seed=42):
+        self.fleet = fleet
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.randomiser = random.Random(seed)
+        self.throttled = 0
+        self.alarms = {pair: {} for pair in fleet}
+        self.tags = {db['DBInstanceArn']: db['TagList'] for dbs in fleet.values() for db in dbs}
+        self.lock = threading.Lock()
+        self.handlers = {
+            'AssumeRole': self.assume_role,
+            'DescribeDBInstances': self.describe_db_instances,
+            'ListTagsForResource': self.list_tags_for_resource,
+            'GetResources': self.get_resources,
+            'DescribeAlarms': self.describe_alarms,
+            'PutMetricAlarm': self.put_metric_alarm,
+            'DeleteAlarms': self.delete_alarms
+        }
+
+    # Hooked into every client: keep the caller's parameters, answer each attempt instead of sending it,
+    # then fill in the result of the attempt that succeeded.
+    def attach(self, client, account_id, region):
+        # Newer botocore picks one of several protocols a service supports, older releases only know one.
+        service_model = client.meta.service_model
+        protocol = getattr(service_model, 'resolved_protocol', service_model.protocol)
+        client.meta.events.register('before-parameter-build', self.keep_params)
+        client.meta.events.register('before-send', partial_call(self.send, protocol))
+        client.meta.events.register('after-call', partial_call(self.answer, account_id, region))
+
+    def keep_params(self, params, context, **kwargs):
+        context['fake_aws_params'] = dict(params)
+
+    def send(self, protocol, event_name, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        with self.lock:
+            throttled = self.randomiser.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+
+        if throttled:
+            return get_http_response(protocol, event_name.split('.')[-1], 400,
+                                     {'Code': 'Throttling', 'Message': 'Rate exceeded'})
+        return get_http_response(protocol, event_name.split('.')[-1], 200)
+
+    def answer(self, account_id, region, http_response, parsed, model, context, **kwargs):
+        if http_response.status_code == 200:
+            parsed.update(self.handlers[model.name](account_id, region, context['fake_aws_params']))
+
+    def assume_role(self, account_id, region, params):
+        role_account = params['RoleArn'].split(':')[4]
+
+        return {'Credentials': {'AccessKeyId': 'FAKE' + role_account, 'SecretAccessKey': 'fake',
+                                'SessionToken': 'fake',
+                                'Expiration': datetime.now(timezone.utc) + timedelta(hours=1)}}
+
+    def describe_db_instances(self, account_id, region, params):
+        dbs = self.fleet.get((account_id, region), [])
+        start = int(params.get('Marker') or 0)
+        page_size = params.get('MaxRecords', 100)
+        response = {'DBInstances': [get_db_record(db) for db in dbs[start:start + page_size]]}
+
+        if start + page_size < len(dbs):
+            response['Marker'] = str(start + page_size)
+
+        return response
+
+    def list_tags_for_resource(self, account_id, region, params):
+        return {'TagList': self.tags.get(params['ResourceName'], [])}
+
+    def get_resources(self, account_id, region, params):
+        tagged = [db for db in self.fleet.get((account_id, region), []) if db['TagList']]
+        start = int(params.get('PaginationToken') or 0)
+        page_size = params.get('ResourcesPerPage', 100)
+        response = {'ResourceTagMappingList': [{'ResourceARN': db['DBInstanceArn'], 'Tags': db['TagList']}
+                                               for db in tagged[start:start + page_size]],
+                    'PaginationToken': ''}
+
+        if start + page_size < len(tagged):
+            response['PaginationToken'] = str(start + page_size)
+
+        return response
+
+    def describe_alarms(self, account_id, region, params):
+        with self.lock:
+            alarms = self.alarms[(account_id, region)]
+
+            if 'AlarmNames' in params:
+                matching = [alarms[name] for name in params['AlarmNames'] if name in alarms]
+            else:
+                prefix = params.get('AlarmNamePrefix', '')
+                matching = [alarm for name, alarm in sorted(alarms.items()) if name.startswith(prefix)]
+
+        start = int(params.get('NextToken') or 0)
+        page_size = params.get('MaxRecords', 100)
+        response = {'MetricAlarms': matching[start:start + page_size]}
+
+        if start + page_size < len(matching):
+            response['NextToken'] = str(start + page_size)
+
+        return response
+
+    def put_metric_alarm(self, account_id, region, params):
+        with self.lock:
+            self.alarms[(account_id, region)][params['AlarmName']] = dict(params)
+
+        return {}
+
+    def delete_alarms(self, account_id, region, params):
+        with self.lock:
+            alarms = self.alarms[(account_id, region)]
+            for name in params['AlarmNames']:
+                alarms.pop(name, None)
+
+        return {}
+
+    def alarm_count(self):
+        with self.lock:
+            return sum(len(alarms) for alarms in self.alarms.values())
+
+
+def partial_call(function, *args):
+    def call(**kwargs):
+        return function(*args, **kwargs)
+    return call
+
+
+# The raw body of an HTTP response, which is all AWSResponse reads from it.
+class FakeBody:
+
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+# A response to operation in the service's wire protocol: empty on success, or an error with error's
+# Code and Message. The success body is only there so the parser accepts it.
+def get_http_response(protocol, operation, status_code, error=None):
+    headers = {}
+
+    if protocol == 'query':
+        if error:
+            body = "<ErrorResponse><Error><Code>{0}</Code><Message>{1}</Message></Error></ErrorResponse>".format(
+                error['Code'], error['Message'])
+        else:
+            body = "<{0}Response><{0}Result/></{0}Response>".format(operation)
+        body = body.encode('utf-8')
+    elif protocol == 'smithy-rpc-v2-cbor':
+        headers['smithy-protocol'] = 'rpc-v2-cbor'
+        body = get_cbor_map({'__type': error['Code'], 'message': error['Message']}) if error else b''
+    else:
+        body = json.dumps({'__type': error['Code'], 'message': error['Message']} if error else {}).encode('utf-8')
+
+    return AWSResponse(None, status_code, headers, FakeBody(body))
+
+
+# Just enough CBOR for a map of short strings, which is all an error body needs.
+def get_cbor_map(values):
+    def get_text(text):
+        encoded = text.encode('utf-8')
+        header = bytes([0x60 + len(encoded)]) if len(encoded) < 24 else bytes([0x78, len(encoded)])
+        return header + encoded
+
+    return bytes([0xa0 + len(values)]) + b''.join(get_text(key) + get_text(value) for key, value in values.items())
+
+
+def get_db_record(db):
+    record = {key: db[key] for key in ('DBInstanceIdentifier', 'DBInstanceArn', 'Engine', 'AllocatedStorage')}
+
+    if db['HasTagList']:
+        record['TagList'] = db['TagList']
+
+    return record
+
+
+# Stands in for the botocore session of rds-alarms' ClientRegistry. Builds real clients with dummy credentials
+# and attaches the fake to each. The account is recovered from the fake credentials STS handed out.
+class FakeSession:
+
+    def __init__(self, fake_aws):
+        self.fake_aws = fake_aws
+        self.session = botocore.session.get_session()
+
+    def create_client(self, service, aws_access_key_id='FAKE', aws_secret_access_key='fake', aws_session_token=None,
+                      region_name=None, **kwargs):
+        client = self.session.create_client(service, aws_access_key_id=aws_access_key_id,
+                                            aws_secret_access_key=aws_secret_access_key,
+                                            aws_session_token=aws_session_token,
+                                            region_name=region_name or 'us-east-1', **kwargs)
+        account_id = aws_access_key_id[len('FAKE'):] or None
+        self.fake_aws.attach(client, account_id, region_name)
+
+        return client
+
+
+# Runs in its own process: builds the fleet, runs lambda_handler `runs` times and reports the results.
+# The first run creates every alarm, later runs measure a steady fleet where nothing needs writing.
+def run_scenario(scenario):
+    rds_alarms = load_rds_alarms()
+
+    # Start the limiters at the configured rate, --throttle-rate is what makes them back off.
+    rds_alarms.INITIAL_REQUEST_RATE = scenario['rate']
+    rds_alarms.MAX_REQUEST_RATE = max(rds_alarms.MAX_REQUEST_RATE, scenario['rate'])
+
+    accounts = ["{0:012d}".format(100000000000 + number) for number in range(scenario['accounts'])]
+    regions = list(ALL_REGIONS[:scenario['regions']])
+    fleet = generate_fleet(scenario['instances'], accounts, regions)
+
+    fake_aws = FakeAws(fleet, scenario['latency_ms'] / 1000, scenario['throttle_rate'])
+    rds_alarms.client_registry.session = FakeSession(fake_aws)
+
+    event = {
+        "roleName": ROLE_NAME,
+        "snsName": SNS_NAME,
+        "accounts": accounts,
+        "regions": regions,
+        "concurrency": scenario['concurrency'],
+        "streaming": scenario['streaming'],
+        "logLevel": "WARNING",
+        "alarmConfig": ALARM_CONFIG
+    }
+
+    if scenario['state_dir']:
+        event['stateStore'] = {'type': 'json', 'path': os.path.join(scenario['state_dir'], str(os.getpid()))}
+
+    runs = []
+    for _ in range(scenario['runs']):
+        started = time.monotonic()
+        result = rds_alarms.lambda_handler(event, None)
+        wall_time = time.monotonic() - started
+
+        report = result['report']
+        runs.append({
+            'wallSeconds': round(wall_time, 3),
+            'failedPairs': result['failed'],
+            'alarmsWritten': report['alarmsWritten'],
+            'dbInstancesSkipped': report['dbInstancesSkipped'],
+            'apiCalls': {api_name: api_metrics['calls'] for api_name, api_metrics in report['apis'].items()},
+            'apiThrottles': sum(api_metrics['throttles'] for api_metrics in report['apis'].values()),
+            'apiRetries': sum(api_metrics['retries'] for api_metrics in report['apis'].values()),
+            'stagesMs': {stage: stage_metrics['totalMs'] for stage, stage_metrics in report['stages'].items()}
+        })
+
+    # ru_maxrss is KB on Linux.
+    peak_memory_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return dict(scenario, alarmsInFake=fake_aws.alarm_count(), peakMemoryMb=round(peak_memory_mb, 1), runs=runs)
+
+
+def print_results(results):
+    print("{0:>9} {1:>6} {2:>9} {3:>4} {4:>9} {5:>9} {6:>8} {7:>10} {8:>9} {9:>9} {10:>9}".format(
+        "instances", "pairs", "mode", "run", "wall (s)", "writes", "skipped", "api calls", "throttled", "retries",
+        "peak MB"))
+
+    for result in results:
+        mode = "streaming" if result['streaming'] else "batch"
+        for number, run in enumerate(result['runs'], start=1):
+            print("{0:>9} {1:>6} {2:>9} {3:>4} {4:>9.2f} {5:>9} {6:>8} {7:>10} {8:>9} {9:>9} {10:>9}".format(
+                result['instances'], result['accounts'] * result['regions'], mode, number, run['wallSeconds'],
+                run['alarmsWritten'], run['dbInstancesSkipped'], sum(run['apiCalls'].values()), run['apiThrottles'],
+                run['apiRetries'], result['peakMemoryMb']))
+
+            if run['failedPairs']:
+                print("    {0} account/region pairs failed".format(run['failedPairs']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline scale benchmark for rds-alarms")
+    parser.add_argument('--sizes', default="100,1000,10000,50000", help="Fleet sizes to run, comma separated")
+    parser.add_argument('--accounts', type=int, default=20, help="Accounts in the synthetic fleet")
+    parser.add_argument('--regions', type=int, default=4, help="Regions per account, up to {0}"
+                        .format(len(ALL_REGIONS)))
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="Injected latency of every API call")
+    parser.add_argument('--concurrency', type=int, default=8, help="lambda_handler concurrency")
+    parser.add_argument('--rate', type=float, default=1000.0, help="Starting requests/second per rate limiter")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Share of API attempts answered with a Throttling error, 0 to 1")
+    parser.add_argument('--runs', type=int, default=2, help="Runs per scenario, the first one creates the alarms")
+    parser.add_argument('--modes', default="batch,streaming", help="batch and/or streaming")
+    parser.add_argument('--state-dir', default=None,
+                        help="Use a json state store under this directory, so repeat runs are incremental")
+    parser.add_argument('--json', default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    scenarios = []
+    for size in args.sizes.split(','):
+        for mode in args.modes.split(','):
+            scenarios.append({
+                'instances': int(size),
+                'accounts': args.accounts,
+                'regions': min(args.regions, len(ALL_REGIONS)),
+                'latency_ms': args.latency_ms,
+                'concurrency': args.concurrency,
+                'rate': args.rate,
+                'throttle_rate': args.throttle_rate,
+                'runs': args.runs,
+                'streaming': mode == 'streaming',
+                'state_dir': args.state_dir
+            })
+
+    results = []
+    for scenario in scenarios:
+        # A fresh process per scenario, so caches start cold and peak memory isn't carried over.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(executor.submit(run_scenario, scenario).result())
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
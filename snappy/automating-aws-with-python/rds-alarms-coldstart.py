@@ -0,0 +1,75 @@
+# Cold start check for rds-alarms.py.
+#
+# Loads the script in fresh Python processes the way Lambda does (AWS_LAMBDA_FUNCTION_NAME set, credentials and
+# region from the environment) and times the import and module initialisation, including the service model
+# preload. Also times building the clients a first invocation needs for a member account, which the preload is
+# meant to make cheap. Nothing is sent to AWS, the credentials are dummies and no API is called.
+#
+# Exits non-zero if the median init time is over the budget, so it can run in CI:
+#
+#   python rds-alarms-coldstart.py --runs 5 --budget-ms 1000
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RDS_ALARMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rds-alarms.py')
+
+# Median milliseconds the import and init of rds-alarms.py may take before the check fails.
+DEFAULT_BUDGET_MS = 1000
+
+# Runs in the child process: load rds-alarms.py, then build the clients of a member account.
+CHILD_SCRIPT = '''
+import importlib.util, json, sys, time
+
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('rds_alarms', sys.argv[1])
+rds_alarms = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rds_alarms)
+initialised = time.perf_counter()
+
+credentials = {'AccessKeyId': 'AKIDCOLDSTART', 'SecretAccessKey': 'secret', 'SessionToken': 'token'}
+rds_alarms.get_rds_client(credentials, 'eu-west-1', '123456789012').get_paginator('describe_db_instances')
+rds_alarms.client_registry.get_client('cloudwatch', '123456789012', 'eu-west-1',
+                                      credentials).get_paginator('describe_alarms')
+finished = time.perf_counter()
+
+print(json.dumps({'initMs': (initialised - started) * 1000, 'firstClientsMs': (finished - initialised) * 1000}))
+'''
+
+
+def measure_once():
+    env = dict(os.environ, AWS_LAMBDA_FUNCTION_NAME='rds-alarms-coldstart', AWS_REGION='ap-southeast-2',
+               AWS_DEFAULT_REGION='ap-southeast-2', AWS_ACCESS_KEY_ID='AKIDCOLDSTART',
+               AWS_SECRET_ACCESS_KEY='secret', AWS_SESSION_TOKEN='token')
+    env.pop('AWS_PROFILE', None)
+
+    output = subprocess.run([sys.executable, '-c', CHILD_SCRIPT, RDS_ALARMS_PATH], env=env, check=True,
+                            capture_output=True, text=True).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the Lambda cold start of rds-alarms.py.")
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes to measure")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help="fail if the median import and init time is over this")
+    args = parser.parse_args()
+
+    measurements = [measure_once() for _ in range(args.runs)]
+    init_ms = statistics.median(measurement['initMs'] for measurement in measurements)
+    first_clients_ms = statistics.median(measurement['firstClientsMs'] for measurement in measurements)
+
+    print("import and init: {0:.0f} ms (budget {1:.0f} ms)".format(init_ms, args.budget_ms))
+    print("first member account clients: {0:.0f} ms".format(first_clients_ms))
+
+    if init_ms > args.budget_ms:
+        print("Cold start is over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,151 +1,1237 @@
-import boto3 
-from botocore.exceptions import ClientError 
- 
-HTTP_OK = 200 
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import botocore.session
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+HTTP_OK = 200
+
+# Log level comes from the LOG_LEVEL environment variable, or "logLevel" in the event. DEBUG logs every
+# instance and alarm, INFO just a summary line per (account, region) and the run report.
+logger = logging.getLogger("rds-alarms")
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# Upper bounds (ms) of the API latency histogram buckets, anything slower goes in the last bucket.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Every alarm this tool manages is named aws-rds-<instance identifier>-<alarm>.
+ALARM_NAME_PREFIX = "aws-rds-"
+
+# delete_alarms and describe_alarms take at most 100 alarm names per call.
+DELETE_ALARMS_BATCH_SIZE = 100
+DESCRIBE_ALARMS_BATCH_SIZE = 100
+
+# Most orphaned alarms a single run deletes across all accounts and regions, unless "maxDeletes" says otherwise.
+# A listing that comes back short would otherwise make every alarm look orphaned.
+DEFAULT_MAX_ALARM_DELETES = 500
+
+# Alarm settings compared as-is when deciding if an existing alarm needs updating.
+# Threshold, AlarmActions and Dimensions need normalising first and are compared in alarm_differs.
+ALARM_COMPARE_KEYS = ('ComparisonOperator', 'DatapointsToAlarm', 'EvaluationPeriods', 'MetricName', 'Namespace',
+                      'Period', 'Statistic', 'ActionsEnabled', 'AlarmDescription', 'Unit')
+
+# Default number of (account, region) pairs processed at the same time.
+DEFAULT_CONCURRENCY = 8
+
+# How many pages of DB instances streaming mode fetches ahead of the alarm work.
+STREAM_QUEUE_SIZE = 2
+
+# Concurrent list_tags_for_resource calls per region when tags have to be looked up one instance at a time.
+TAG_LOOKUP_CONCURRENCY = 8
+
+# CloudWatch namespace for the optional Embedded Metric Format output of the run report.
+DEFAULT_METRICS_NAMESPACE = "RdsAlarms"
+
+# Size of each shared client's HTTP connection pool, enough for the per-ARN tag lookups of a region.
+MAX_POOL_CONNECTIONS = TAG_LOOKUP_CONCURRENCY * 2
+
+# Requests per second each (account, region, API) starts at. The rate halves on every throttling error and
+# grows by RATE_RECOVERY_FACTOR on every successful call, staying between MIN_REQUEST_RATE and MAX_REQUEST_RATE.
+INITIAL_REQUEST_RATE = 10.0
+MIN_REQUEST_RATE = 0.5
+MAX_REQUEST_RATE = 50.0
+RATE_RECOVERY_FACTOR = 1.05
+
+# Throttled or transient failures are retried with full jitter backoff: a random wait between 0 and
+# RETRY_BASE_DELAY * 2^attempt seconds, capped at RETRY_MAX_DELAY. After MAX_ATTEMPTS the error is raised.
+MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 20.0
+
+# Error codes AWS services return when the caller is being rate limited.
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+                          'PriorRequestNotComplete')
+
+# Server side errors that are worth another attempt.
+TRANSIENT_ERROR_CODES = ('RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalFailure',
+                         'ServiceUnavailable')
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+
+# Assumed role credentials are refreshed once they are this close to expiring. A Lambda run can last up to
+# 15 minutes, so cached credentials must outlive the whole run.
+CREDENTIAL_REFRESH_MARGIN = timedelta(minutes=15)
  
 # Engine Types: 
 AURORA = "aurora" 
- 
- 
-def lambda_handler(event, context): 
-    if not validate_input(event): 
-        raise Exception("Invalid Json Input from CloudWatch. Exiting") 
- 
-    role_name = event['roleName'] 
-    sns_name = event['snsName'] 
- 
-    for account_id in event['accounts']: 
- 
-        credentials = get_credentials(account_id, role_name) 
- 
-        for region in event['regions']: 
- 
-            print("getting db_instances for: " + region + " account: " + account_id) 
- 
-            alarm_tools = AwsAlarmTools(event['alarmConfig'], credentials, region) 
- 
-            sns_arn = "arn:aws:sns:{0}:{1}:{2}".format(region, account_id, sns_name) 
- 
-            db_instances = get_all_db_instances(credentials, region) 
- 
-            if any(db_instances): 
- 
-                print("I have {0} db_instances to process for: {1} account: {2}" 
-                      .format(len(db_instances), region, account_id)) 
- 
-                for db_instance in db_instances: 
- 
-                    # calculate the alarm configs needed for this DB Instance. 
-                    db_instance.alarm_configs = alarm_tools.get_all_rds_alarm_configs(db_instance, sns_arn) 
- 
-                    # create the required alarms. 
-                    for alarm in db_instance.alarm_configs: 
-                        alarm_tools.create_alarm(alarm, namespace='AWS/RDS') 
- 
-            else: 
-                print("No db_instances to process for: " + region + " account: " + account_id) 
- 
- 
+
+# Alarm types: (alarmConfig key without the live/test prefix, metric name, alarm name suffix, unit,
+# whether alarmConfig sets the threshold).
+ALARM_TYPES = {
+    'rds-cpu': ('CpuAlarm', 'CPUUtilization', '-High-CPU-Utilization', 'Percent', True),
+    'rds-storage': ('StorageAlarm', 'FreeStorageSpace', '-Low-FreeStorageSpace', 'Bytes', True),
+    'rds-queuelength': ('QueueLengthAlarm', 'DiskQueueDepth', '-High-DiskQueueDepth', 'Count', False),
+}
+
+# Environment tag values that get the live alarm settings, everything else gets the test settings.
+LIVE_ENVIRONMENTS = ("live", "liveb")
+
+COMPARISON_OPERATORS = ('GreaterThanOrEqualToThreshold', 'GreaterThanThreshold', 'LessThanThreshold',
+                        'LessThanOrEqualToThreshold')
+
+# Work queue sweeps: a received work item stays hidden from other workers for WORK_ITEM_VISIBILITY_TIMEOUT seconds.
+# If it isn't acknowledged by then (the worker was killed) it becomes visible again and is redone.
+WORK_ITEM_VISIBILITY_TIMEOUT = 300
+
+# A work item that fails is queued again, until it has been tried this many times.
+MAX_WORK_ITEM_ATTEMPTS = 3
+
+# Workers stop taking new work items once the Lambda invocation has less than this left, the rest stay queued
+# for the next invocation.
+WORK_QUEUE_TIME_MARGIN_MS = 60000
+
+# Instance events don't carry the sweep's settings. They are read from this environment variable as JSON with the
+# same roleName, snsName and alarmConfig keys, plus optional accounts and regions to limit which events are acted on.
+SETTINGS_ENV_VAR = "RDS_ALARMS_SETTINGS"
+
+# What each instance event means for the instance's alarms: reconcile them, or delete them.
+# "RDS DB Instance Event" by event category, "AWS API Call via CloudTrail" by API name.
+INSTANCE_EVENT_CATEGORIES = {
+    'creation': 'reconcile',
+    'configuration change': 'reconcile',
+    'deletion': 'delete',
+}
+INSTANCE_API_CALLS = {
+    'CreateDBInstance': 'reconcile',
+    'CreateDBInstanceReadReplica': 'reconcile',
+    'RestoreDBInstanceFromDBSnapshot': 'reconcile',
+    'RestoreDBInstanceToPointInTime': 'reconcile',
+    'ModifyDBInstance': 'reconcile',
+    'AddTagsToResource': 'reconcile',
+    'RemoveTagsFromResource': 'reconcile',
+    'DeleteDBInstance': 'delete',
+}
+
+# Services and paginators this script uses. In Lambda their models are loaded while the container initialises,
+# rather than during the first invocation.
+PRELOAD_SERVICES = {
+    'sts': (),
+    'rds': ('describe_db_instances',),
+    'cloudwatch': ('describe_alarms',),
+    'resourcegroupstaggingapi': ('get_resources',),
+}
+
+# Part of every instance fingerprint. Bump it when the way alarms are built changes, so the next run
+# reprocesses every instance instead of trusting fingerprints taken with the old logic.
+FINGERPRINT_VERSION = "1"
+ 
+ 
+def lambda_handler(event, context):
+    # EventBridge events reconcile just the one DB instance they are about, the scheduled sweep does everything.
+    if event is not None and 'detail-type' in event:
+        return handle_instance_event(event)
+
+    if not validate_input(event):
+        raise Exception("Invalid Json Input from CloudWatch. Exiting")
+
+    logger.setLevel(event.get('logLevel', os.environ.get('LOG_LEVEL', 'INFO')))
+
+    role_name = event['roleName']
+    sns_name = event['snsName']
+    concurrency = get_concurrency(event)
+
+    # Compile the alarm settings once, a bad alarmConfig fails here before any AWS calls are made.
+    alarm_templates = AlarmTemplates(event['alarmConfig'])
+
+    run_metrics.reset()
+    streaming = bool(event.get('streaming', False))
+
+    # Optional: only instances that are new or changed since the last run get their alarms reconciled.
+    state_store = get_state_store(event.get('stateStore'))
+    full_reconcile = bool(event.get('fullReconcile', False))
+
+    # Optional: delete alarms left behind by DB instances that no longer exist.
+    orphan_collector = get_orphan_collector(event.get('orphanAlarms'))
+
+    # Optional: work through the sweep one page of DB instances at a time from a queue, so an invocation that runs
+    # out of time leaves the rest for the next one instead of losing it.
+    work_queue = get_work_queue(event.get('workQueue'))
+    if work_queue is not None:
+        # Both need every instance of a region in one place, a work item only sees one page.
+        if state_store is not None or orphan_collector is not None:
+            raise Exception("stateStore and orphanAlarms can't be used with workQueue")
+
+        seed = bool(event['workQueue'].get('seed', False))
+        return run_work_queue(work_queue, event, alarm_templates, concurrency, context, seed)
+
+    results = []
+    account_credentials = {}
+
+    # Assume the role once per account, every region in that account shares the credentials.
+    # An account we can't get into is reported against each of its regions and skipped.
+    for account_id in event['accounts']:
+        try:
+            with run_metrics.timer('credentials'):
+                account_credentials[account_id] = get_credentials(account_id, role_name)
+        except Exception as e:
+            log(logging.ERROR, "Failed to get credentials", account=account_id, error=str(e))
+            for region in event['regions']:
+                results.append(get_pair_result(account_id, region, error=e))
+
+    pairs = [(account_id, region) for account_id in event['accounts'] if account_id in account_credentials
+             for region in event['regions']]
+
+    if any(pairs):
+        log(logging.INFO, "Processing account/region pairs", pairs=len(pairs), concurrency=concurrency)
+
+        # One worker per (account, region) pair. A failing pair is recorded and does not stop the others.
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(pairs))) as executor:
+            futures = {}
+            for account_id, region in pairs:
+                future = executor.submit(process_account_region, alarm_templates,
+                                         account_credentials[account_id], account_id, region, sns_name,
+                                         streaming=streaming, state_store=state_store,
+                                         full_reconcile=full_reconcile, orphan_collector=orphan_collector)
+                futures[future] = (account_id, region)
+
+            for future in as_completed(futures):
+                account_id, region = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    log(logging.ERROR, "Failed to process account/region", account=account_id, region=region,
+                        error=str(e))
+                    results.append(get_pair_result(account_id, region, error=e))
+
+    return summarise_results(results, event.get('metrics'))
+
+
+# Reconciles the alarms of the single DB instance an EventBridge event is about, in a fixed number of API calls
+# whatever the size of the fleet. Anything missed here is picked up by the next full sweep.
+# Raises if the alarms couldn't be reconciled, so Lambda retries the event.
+def handle_instance_event(event):
+    settings = get_settings(event)
+    logger.setLevel(settings.get('logLevel', os.environ.get('LOG_LEVEL', 'INFO')))
+
+    instance_event = get_instance_event(event)
+    if instance_event is None:
+        log(logging.INFO, "Ignoring event", detail_type=event.get('detail-type'), source=event.get('source'))
+        return {'action': None}
+
+    action, account_id, region, identifier = instance_event
+
+    if account_id not in settings.get('accounts', [account_id]) or region not in settings.get('regions', [region]):
+        log(logging.INFO, "Ignoring event outside the configured accounts/regions", account=account_id,
+            region=region, identifier=identifier)
+        return {'action': None}
+
+    log(logging.INFO, "Processing instance event", account=account_id, region=region, identifier=identifier,
+        action=action, detail_type=event['detail-type'])
+
+    alarm_templates = AlarmTemplates(settings['alarmConfig'])
+    run_metrics.reset()
+
+    with run_metrics.timer('credentials'):
+        credentials = get_credentials(account_id, settings['roleName'])
+
+    alarm_tools = AwsAlarmTools(alarm_templates, credentials, region, account_id)
+    alarm_tools.load_alarms(get_alarm_names(identifier))
+
+    # Whatever the event said, an instance that is gone or going only needs its alarms removed.
+    db_instance = None
+    if action == 'reconcile':
+        db_instance = get_db_instance(credentials, region, account_id, identifier)
+        if db_instance is None:
+            action = 'delete'
+
+    alarm_count = 0
+    if action == 'delete':
+        alarm_names = sorted(alarm_tools.alarm_index)
+        if alarm_tools.delete_alarms(alarm_names) != len(alarm_names):
+            raise Exception("Failed to delete alarms for DB instance: " + identifier)
+    else:
+        sns_arn = "arn:aws:sns:{0}:{1}:{2}".format(region, account_id, settings['snsName'])
+        alarm_count, failed_identifiers = reconcile_db_instances(alarm_tools, [db_instance], sns_arn)
+        if any(failed_identifiers):
+            raise Exception("Failed to reconcile alarms for DB instance: " + identifier)
+
+    log(logging.INFO, "Finished instance event", account=account_id, region=region, identifier=identifier,
+        action=action, alarms_written=alarm_tools.alarms_written, alarms_deleted=alarm_tools.alarms_deleted)
+
+    return {
+        'account': account_id,
+        'region': region,
+        'dbInstance': identifier,
+        'action': action,
+        'alarms': alarm_count,
+        'alarmsWritten': alarm_tools.alarms_written,
+        'alarmsDeleted': alarm_tools.alarms_deleted,
+        'report': run_metrics.get_report()
+    }
+
+
+# The settings for instance events: the JSON in SETTINGS_ENV_VAR, with any of its keys also present in the
+# event (from an EventBridge input transformer) taking precedence.
+def get_settings(event):
+    settings_json = os.environ.get(SETTINGS_ENV_VAR)
+    if settings_json is None:
+        raise Exception("Instance events need the {0} environment variable".format(SETTINGS_ENV_VAR))
+
+    try:
+        settings = json.loads(settings_json)
+    except ValueError as e:
+        raise Exception("Invalid Json in {0}: {1}".format(SETTINGS_ENV_VAR, e))
+
+    for key in ('roleName', 'snsName', 'alarmConfig', 'accounts', 'regions', 'logLevel'):
+        if key in event:
+            settings[key] = event[key]
+
+    for key in ('roleName', 'snsName', 'alarmConfig'):
+        if settings.get(key) is None:
+            raise Exception("{0} is missing from {1}".format(key, SETTINGS_ENV_VAR))
+
+    return settings
+
+
+# Works out (action, account, region, DB instance identifier) from an EventBridge event, or None if the event
+# doesn't affect any alarms. Handles RDS instance events, CloudTrail RDS API calls and RDS tag changes.
+def get_instance_event(event):
+    detail_type = event.get('detail-type')
+    detail = event.get('detail') or {}
+    action = None
+    identifier = None
+
+    if detail_type == 'RDS DB Instance Event':
+        for category in detail.get('EventCategories', []):
+            action = action or INSTANCE_EVENT_CATEGORIES.get(category)
+        identifier = detail.get('SourceIdentifier')
+
+    elif detail_type == 'AWS API Call via CloudTrail' and event.get('source') == 'aws.rds':
+        # A call that failed didn't change anything.
+        if detail.get('errorCode') is None:
+            action = INSTANCE_API_CALLS.get(detail.get('eventName'))
+
+        request = detail.get('requestParameters') or {}
+        identifier = request.get('dBInstanceIdentifier') or get_db_identifier(request.get('resourceName'))
+
+    elif detail_type == 'Tag Change on Resource' and detail.get('service') == 'rds' and \
+            detail.get('resource-type') == 'db':
+        action = 'reconcile'
+        identifier = get_db_identifier(next(iter(event.get('resources', [])), None))
+
+    if action is None or not identifier:
+        return None
+
+    return action, event['account'], event['region'], identifier.lower()
+
+
+# The identifier from a DB instance ARN, arn:aws:rds:<region>:<account>:db:<identifier>. None for anything else.
+def get_db_identifier(db_arn):
+    if db_arn is None:
+        return None
+
+    arn_parts = db_arn.split(':')
+    if len(arn_parts) != 7 or arn_parts[2] != 'rds' or arn_parts[5] != 'db':
+        return None
+
+    return arn_parts[6]
+
+
+# Works through the sweep as (account, region, page) work items from work_queue, with concurrency workers.
+# With seed, and only if the queue is empty, a new sweep is queued first, one item per (account, region).
+# Only the scheduled invocation should seed: the empty check and the put aren't atomic, so several workers
+# seeding at once would each queue a whole sweep. Every other invocation just drains what is there.
+# Each item queues the next page of its region before it is acknowledged, so an item is only gone from the queue
+# once its page is done and the next one is safely queued. Other invocations can drain the same queue at the same
+# time. The sweep is only reported complete if the queue is empty and this invocation dropped no items.
+def run_work_queue(work_queue, event, alarm_templates, concurrency, context, seed=False):
+    if not seed:
+        log(logging.INFO, "Draining the work queue")
+    elif work_queue.is_empty():
+        work_queue.put([get_work_item(account_id, region) for account_id in event['accounts']
+                        for region in event['regions']])
+        log(logging.INFO, "Queued new sweep", accounts=len(event['accounts']), regions=len(event['regions']))
+    else:
+        log(logging.WARNING, "Previous sweep is still queued, not seeding a new one")
+
+    results = {}
+    dropped = []
+    results_lock = threading.Lock()
+    tagging_caches = {}
+
+    def work():
+        while has_time_left(context):
+            received = work_queue.receive()
+            if received is None:
+                return
+
+            receipt, item = received
+            pair = (item['account'], item['region'])
+            result, requeued = process_work_item(work_queue, alarm_templates, event['roleName'], event['snsName'],
+                                                 item, tagging_caches.setdefault(pair, {}))
+            work_queue.ack(receipt)
+
+            with results_lock:
+                results[pair] = merge_pair_results(results.get(pair), result)
+                if not requeued:
+                    dropped.append(item)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(work) for _ in range(concurrency)]:
+            future.result()
+
+    summary = summarise_results(list(results.values()), event.get('metrics'))
+    # The pages after a dropped item were never queued, so that region wasn't swept in full.
+    summary['workItemsDropped'] = dropped
+    summary['complete'] = not dropped and work_queue.is_empty()
+
+    return summary
+
+
+# Does one work item: reconciles the alarms of one page of DB instances and queues the region's next page.
+# A failed item is queued again with one more attempt, up to MAX_WORK_ITEM_ATTEMPTS, after that it is dropped.
+# Returns the item's result and whether the rest of its region is still queued.
+def process_work_item(work_queue, alarm_templates, role_name, sns_name, item, tagging_cache):
+    account_id, region = item['account'], item['region']
+
+    try:
+        with run_metrics.timer('credentials'):
+            credentials = get_credentials(account_id, role_name)
+
+        db_instances, next_marker = get_db_instance_page(credentials, region, account_id, item['marker'],
+                                                         tagging_cache)
+
+        alarm_tools = AwsAlarmTools(alarm_templates, credentials, region, account_id)
+        alarm_tools.load_alarms([alarm_name for db_instance in db_instances
+                                 for alarm_name in get_alarm_names(db_instance.instance_identifier)])
+
+        sns_arn = "arn:aws:sns:{0}:{1}:{2}".format(region, account_id, sns_name)
+        alarm_count, _ = reconcile_db_instances(alarm_tools, db_instances, sns_arn)
+
+        if next_marker is not None:
+            work_queue.put([get_work_item(account_id, region, next_marker)])
+
+    except Exception as e:
+        attempts = item['attempts'] + 1
+        log(logging.ERROR, "Failed work item", account=account_id, region=region, marker=item['marker'],
+            attempts=attempts, error=str(e))
+
+        if attempts < MAX_WORK_ITEM_ATTEMPTS:
+            work_queue.put([get_work_item(account_id, region, item['marker'], attempts)])
+            return get_pair_result(account_id, region, error=e), True
+
+        log(logging.ERROR, "Dropped work item, the rest of the region won't be swept", account=account_id,
+            region=region, marker=item['marker'])
+        return get_pair_result(account_id, region, error=e), False
+
+    log(logging.DEBUG, "Finished work item", account=account_id, region=region, marker=item['marker'],
+        db_instances=len(db_instances), alarms_written=alarm_tools.alarms_written)
+
+    return get_pair_result(account_id, region, db_instance_count=len(db_instances), alarm_count=alarm_count,
+                           alarms_written=alarm_tools.alarms_written), True
+
+
+def get_work_item(account_id, region, marker=None, attempts=0):
+    return {
+        'account': account_id,
+        'region': region,
+        'marker': marker,
+        'attempts': attempts
+    }
+
+
+# Adds up the results of several work items of the same (account, region). An error stays once there was one.
+def merge_pair_results(total, result):
+    if total is None:
+        return result
+
+    merged = dict(total)
+    for key in ('dbInstances', 'alarms', 'alarmsWritten', 'dbInstancesSkipped', 'alarmsSkipped', 'alarmsOrphaned',
+                'alarmsDeleted'):
+        merged[key] += result[key]
+    merged['error'] = result['error'] or total['error']
+
+    return merged
+
+
+# context is None when run by hand, then there is no time limit.
+def has_time_left(context):
+    return context is None or context.get_remaining_time_in_millis() > WORK_QUEUE_TIME_MARGIN_MS
+
+
+# Does all the work for a single (account, region) pair and returns its result.
+# In streaming mode alarms are reconciled page by page while the next page of DB instances is fetched,
+# instead of waiting for every instance in the region to be listed first.
+# With a state store, instances whose fingerprint matches the last run are skipped, unless full_reconcile is set.
+# With an orphan collector, alarms of instances missing from the listing are deleted once every page is seen.
+def process_account_region(alarm_templates, credentials, account_id, region, sns_name, streaming=False,
+                           state_store=None, full_reconcile=False, orphan_collector=None):
+    log(logging.DEBUG, "Getting db_instances", account=account_id, region=region)
+    started = time.monotonic()
+
+    alarm_tools = AwsAlarmTools(alarm_templates, credentials, region, account_id)
+
+    sns_arn = "arn:aws:sns:{0}:{1}:{2}".format(region, account_id, sns_name)
+
+    # Orphan collection trusts the listing to be complete, so a short one has to fail rather than end early.
+    complete = orphan_collector is not None
+    if streaming:
+        db_instance_pages = prefetch(iter_db_instance_pages(credentials, region, account_id, complete))
+    else:
+        db_instance_pages = [get_all_db_instances(credentials, region, account_id, complete)]
+
+    previous_fingerprints = {}
+    if state_store is not None and not full_reconcile:
+        with run_metrics.timer('state_store'):
+            previous_fingerprints = state_store.load(account_id, region)
+
+    fingerprints = {}
+    live_identifiers = set()
+    db_instance_count = 0
+    skipped_count = 0
+    skipped_alarm_count = 0
+    alarm_count = 0
+
+    for db_instances in db_instance_pages:
+        db_instance_count += len(db_instances)
+        changed_db_instances = []
+
+        for db_instance in db_instances:
+            fingerprint = get_fingerprint(db_instance, alarm_templates, sns_arn)
+            fingerprints[db_instance.instance_identifier] = fingerprint
+            live_identifiers.add(db_instance.instance_identifier)
+
+            if previous_fingerprints.get(db_instance.instance_identifier) == fingerprint:
+                skipped_count += 1
+                skipped_alarm_count += get_alarm_count(db_instance)
+            else:
+                changed_db_instances.append(db_instance)
+
+        checked_count, failed_identifiers = reconcile_db_instances(alarm_tools, changed_db_instances, sns_arn)
+        alarm_count += checked_count
+
+        # Leave failed instances out of the snapshot so the next run tries them again.
+        for identifier in failed_identifiers:
+            del fingerprints[identifier]
+
+    if state_store is not None:
+        with run_metrics.timer('state_store'):
+            state_store.save(account_id, region, fingerprints)
+
+    orphaned_count = 0
+    if orphan_collector is not None:
+        orphaned_count = orphan_collector.collect(alarm_tools, live_identifiers, account_id, region)
+
+    # The one line per (account, region) at INFO.
+    log(logging.INFO, "Finished account/region", account=account_id, region=region, db_instances=db_instance_count,
+        skipped=skipped_count, alarms_written=alarm_tools.alarms_written,
+        alarms_unchanged=alarm_tools.alarms_unchanged, alarms_failed=alarm_tools.alarms_failed,
+        alarms_orphaned=orphaned_count, alarms_deleted=alarm_tools.alarms_deleted,
+        duration_ms=round((time.monotonic() - started) * 1000))
+
+    return get_pair_result(account_id, region, db_instance_count=db_instance_count, alarm_count=alarm_count,
+                           alarms_written=alarm_tools.alarms_written, skipped_count=skipped_count,
+                           skipped_alarm_count=skipped_alarm_count, orphaned_count=orphaned_count,
+                           alarms_deleted=alarm_tools.alarms_deleted)
+
+
+# Creates or updates the alarms for a batch of DB instances.
+# Returns how many alarms were checked and the identifiers of instances where any alarm failed.
+def reconcile_db_instances(alarm_tools, db_instances, sns_arn):
+    alarm_count = 0
+    failed_identifiers = []
+
+    for db_instance in db_instances:
+        failed_before = alarm_tools.alarms_failed
+
+        # calculate the alarm configs needed for this DB Instance.
+        with run_metrics.timer('alarm_configs'):
+            db_instance.alarm_configs = alarm_tools.get_all_rds_alarm_configs(db_instance, sns_arn)
+
+        # create the required alarms.
+        for alarm in db_instance.alarm_configs:
+            alarm_tools.create_alarm(alarm, namespace='AWS/RDS')
+            alarm_count += 1
+
+        if alarm_tools.alarms_failed > failed_before:
+            failed_identifiers.append(db_instance.instance_identifier)
+
+    return alarm_count, failed_identifiers
+
+
+# Everything that decides an instance's alarms: its identifier, engine, storage, environment, the alarm settings
+# for that environment and where the alarms notify. If none of it changed, neither have the alarms.
+def get_fingerprint(db_instance, alarm_templates, sns_arn):
+    fingerprint_input = "|".join((FINGERPRINT_VERSION, db_instance.instance_identifier, db_instance.engine,
+                                  str(db_instance.allocated_storage), db_instance.environment,
+                                  alarm_templates.fingerprint_for_environment(db_instance.environment), sns_arn))
+
+    return hashlib.sha1(fingerprint_input.encode('utf-8')).hexdigest()
+
+
+def get_alarm_count(db_instance):
+    # Aurora only gets the CPU alarm.
+    return 1 if AURORA in db_instance.engine else len(ALARM_TYPES)
+
+
+# Runs a generator on a background thread and hands its items over through a bounded queue, so the producer
+# can fetch ahead while the caller works, but never more than max_items ahead.
+def prefetch(items, max_items=STREAM_QUEUE_SIZE):
+    handover = queue.Queue(maxsize=max_items)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has stopped, otherwise a full queue would block this thread forever.
+        while not stopped.is_set():
+            try:
+                handover.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            has_item, item = handover.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def get_pair_result(account_id, region, db_instance_count=0, alarm_count=0, alarms_written=0, skipped_count=0,
+                    skipped_alarm_count=0, orphaned_count=0, alarms_deleted=0, error=None):
+    return {
+        'account': account_id,
+        'region': region,
+        'dbInstances': db_instance_count,
+        'alarms': alarm_count,
+        'alarmsWritten': alarms_written,
+        'dbInstancesSkipped': skipped_count,
+        'alarmsSkipped': skipped_alarm_count,
+        'alarmsOrphaned': orphaned_count,
+        'alarmsDeleted': alarms_deleted,
+        'error': None if error is None else str(error)
+    }
+
+
+# Logs and returns the run report. metrics_config is the optional "metrics" from the event,
+# {"emf": true, "namespace": "RdsAlarms"} also writes the report as CloudWatch Embedded Metric Format lines.
+def summarise_results(results, metrics_config=None):
+    failed = [result for result in results if result['error'] is not None]
+
+    report = run_metrics.get_report()
+    report['pairs'] = len(results)
+    report['failed'] = len(failed)
+    for key in ('dbInstances', 'dbInstancesSkipped', 'alarms', 'alarmsSkipped', 'alarmsWritten', 'alarmsOrphaned',
+                'alarmsDeleted'):
+        report[key] = sum(result[key] for result in results)
+
+    log(logging.INFO, "Run report", report=report)
+
+    for result in failed:
+        log(logging.ERROR, "Failed account/region", account=result['account'], region=result['region'],
+            error=result['error'])
+
+    if metrics_config and metrics_config.get('emf'):
+        write_emf_metrics(report, metrics_config.get('namespace', DEFAULT_METRICS_NAMESPACE))
+
+    return {
+        'pairs': len(results),
+        'failed': len(failed),
+        'results': results,
+        'report': report
+    }
+
+
+# Logs one JSON object per line so CloudWatch Logs Insights can filter and aggregate on the fields.
+# Checks the level first, the hot loops log at DEBUG and shouldn't pay for building the message.
+def log(level, message, **fields):
+    if logger.isEnabledFor(level):
+        fields['level'] = logging.getLevelName(level)
+        fields['message'] = message
+        logger.log(level, json.dumps(fields, default=str))
+
+
+# How many (account, region) pairs to work on at the same time. Optional "concurrency" in the event.
+def get_concurrency(event):
+    concurrency = event.get('concurrency', DEFAULT_CONCURRENCY)
+
+    try:
+        concurrency = int(concurrency)
+    except (TypeError, ValueError):
+        raise Exception("Invalid concurrency in Json Input: {0}".format(concurrency))
+
+    return max(1, concurrency)
+
+
 def validate_input(event): 
     # We should build this out. 
  
     result = False 
  
-    if event is None: 
-        print("Event object is null") 
-    elif event['roleName'] is None: 
-        print("roleName is null") 
-    elif event['accounts'] is None: 
-        print("Accounts is null") 
-    elif event['regions'] is None: 
-        print("Regions is null") 
+    if event is None:
+        log(logging.ERROR, "Event object is null")
+    elif event['roleName'] is None:
+        log(logging.ERROR, "roleName is null")
+    elif event['accounts'] is None:
+        log(logging.ERROR, "Accounts is null")
+    elif event['regions'] is None:
+        log(logging.ERROR, "Regions is null")
     else: 
         result = True 
  
     return result 
  
  
-def get_credentials(account_id, role_name): 
-    print("AccountId: " + account_id + " RoleName: " + role_name) 
- 
-    sts = boto3.client('sts') 
+def get_credentials(account_id, role_name):
+    credentials = credential_cache.get(account_id, role_name)
+
+    if credentials is not None:
+        log(logging.DEBUG, "Using cached credentials", account=account_id, role=role_name)
+        return credentials
+
+    log(logging.DEBUG, "Assuming role", account=account_id, role=role_name)
+
+    sts = client_registry.get_client('sts')
     role_arn = "arn:aws:iam::" + account_id + ":role/" + role_name 
     response = sts.assume_role(RoleArn=role_arn, 
                                RoleSessionName=role_name) 
  
+    credentials = None
     if response['ResponseMetadata']['HTTPStatusCode'] == HTTP_OK: 
-        print("Assumed Credentials for " + role_name + "successfully") 
+        log(logging.DEBUG, "Assumed role successfully", account=account_id, role=role_name)
         credentials = response['Credentials'] 
  
     if credentials is None or credentials['AccessKeyId'] is None: 
         raise Exception("STS gave an invalid response for assume role ARN: " + role_arn) 
- 
+
+    credential_cache.put(account_id, role_name, credentials)
+
     return credentials 
  
  
-def get_rds_client(credentials, region): 
-    return boto3.client('rds', aws_access_key_id=credentials['AccessKeyId'], 
-                        aws_secret_access_key=credentials['SecretAccessKey'], 
-                        aws_session_token=credentials['SessionToken'], 
-                        region_name=region) 
- 
- 
-# Max number of RDS instances returned by AWS API is 100. If more exists, the response will include a Marker. 
-# Keep feeding the Marker to the API until it returns no Marker. At this point we have all RDS instances. 
-def get_all_db_instances(credentials, region): 
-    db_api_response = [] 
-    pagination_marker = "" 
-    print("get_db_instances for region: " + region) 
- 
-    # There's no Do While in Python, this is the alternative. 
-    while True: 
-        response = get_db_instances(credentials, region, pagination_marker) 
- 
-        if response['ResponseMetadata']['HTTPStatusCode'] == HTTP_OK and any(response['DBInstances']): 
- 
-            db_api_response += response['DBInstances'] 
- 
-            if 'Marker' in response.keys(): 
-                pagination_marker = response['Marker'] 
-            else: 
-                print("No Pagination Marker, we have all DB Instances. Items found: " + str(len(db_api_response))) 
-                break 
-        else: 
-            print("Exiting HTTP CODE: " + str(response['ResponseMetadata']['HTTPStatusCode']) + 
-                  " DBInstances count: " + str(len(response['DBInstances']))) 
-            break 
- 
-    # Prepare a collection of DbInstance objects. 
-    all_db_instances = [] 
- 
-    for db in db_api_response: 
-        tag_list = get_db_tags(credentials, region, db['DBInstanceArn']) 
- 
-        db_instance = DbInstance(db['DBInstanceIdentifier'], db['Engine'], db['AllocatedStorage'], tag_list) 
- 
-        all_db_instances.append(db_instance) 
- 
-    return all_db_instances 
- 
- 
-def get_db_instances(credentials, region, marker=""): 
-    rds_client = get_rds_client(credentials, region) 
-    response = rds_client.describe_db_instances(Marker=marker) 
-    response_marker = "" 
- 
-    if 'Marker' in response.keys(): 
-        response_marker = response['Marker'] 
- 
-    if response['ResponseMetadata']['HTTPStatusCode'] == HTTP_OK: 
-        print("describe_db_instances returned HTTP_OK 200. Marker: " + response_marker) 
- 
-    return response 
- 
- 
-def get_db_tags(credentials, region, db_arn): 
+def get_rds_client(credentials, region, account_id):
+    return client_registry.get_client('rds', account_id, region, credentials)
+
+
+# Shared botocore clients keyed by (account, region, service). Clients are thread safe and keep their HTTP
+# connection pool, so every worker and every warm Lambda invocation reuses them instead of building new ones.
+# All clients come from one session, so each service model is only loaded once.
+# botocore is used directly rather than boto3, which imports s3transfer and the resource layer we have no use for.
+class ClientRegistry:
+
+    def __init__(self, max_pool_connections=MAX_POOL_CONNECTIONS):
+        # Retries are left to api_throttle, botocore only makes a single attempt.
+        self.config = Config(max_pool_connections=max_pool_connections,
+                             retries={'mode': 'standard', 'total_max_attempts': 1})
+        self.clients = {}
+        self.session = None
+        # botocore sessions aren't thread safe, clients have to be created one at a time.
+        self.lock = threading.Lock()
+
+    # Without credentials the client uses the Lambda's own role (or the local profile).
+    def get_client(self, service, account_id=None, region=None, credentials=None):
+        key = (account_id, region, service)
+        access_key_id = credentials['AccessKeyId'] if credentials is not None else None
+
+        with self.lock:
+            cached = self.clients.get(key)
+
+            # Credentials for the account were refreshed, the old client would use expired ones.
+            if cached is not None and cached[0] == access_key_id:
+                return cached[1]
+
+            if self.session is None:
+                self.session = botocore.session.get_session()
+
+            if credentials is None:
+                client = self.session.create_client(service, region_name=region, config=self.config)
+            else:
+                client = self.session.create_client(service, aws_access_key_id=credentials['AccessKeyId'],
+                                                    aws_secret_access_key=credentials['SecretAccessKey'],
+                                                    aws_session_token=credentials['SessionToken'],
+                                                    region_name=region, config=self.config)
+
+            api_throttle.attach(client, account_id, region)
+            self.clients[key] = (access_key_id, client)
+
+            return client
+
+    # Creates a client of each service with the Lambda's own credentials and loads its paginators, so the session
+    # has read every model, endpoint rule set and paginator file it needs. Later clients for other accounts and
+    # regions are built from the cached files. The sts client is the one get_credentials uses.
+    def preload(self, services):
+        for service, paginators in services.items():
+            client = self.get_client(service)
+            for operation in paginators:
+                client.get_paginator(operation)
+
+
+# A token bucket that sets the pace of one (account, region, API). The rate backs off when AWS throttles us
+# and recovers gradually with each successful call, so it settles just under what the API will accept.
+class AdaptiveRateLimiter:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Blocks until this caller may make a request. Tokens may go negative, later callers queue behind.
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(MAX_REQUEST_RATE, self.rate * RATE_RECOVERY_FACTOR)
+
+
+# Rate limits and retries every call made by the shared clients, including the pages of paginators.
+# Hooks into each client's botocore events: before-call waits for the (account, region, API) rate limiter,
+# needs-retry learns from throttling responses and decides whether, and when, to try again, and after-call
+# records the latency. Limiters are kept across warm invocations, the counters in run_metrics are per run.
+class ApiThrottle:
+
+    def __init__(self):
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def attach(self, client, account_id, region):
+        client.meta.events.register('before-call', partial(self.before_call, account_id, region))
+        client.meta.events.register_first('needs-retry', partial(self.needs_retry, account_id, region))
+        client.meta.events.register('after-call', self.after_call)
+        client.meta.events.register('after-call-error', self.after_call)
+
+    def get_limiter(self, account_id, region, api_name):
+        key = (account_id, region, api_name)
+
+        with self.lock:
+            limiter = self.limiters.get(key)
+            if limiter is None:
+                limiter = self.limiters[key] = AdaptiveRateLimiter(INITIAL_REQUEST_RATE)
+
+        return limiter
+
+    def before_call(self, account_id, region, model, context, **kwargs):
+        run_metrics.count_api(model.name, 'calls')
+        self.get_limiter(account_id, region, model.name).acquire()
+
+        # The latency includes any retries, but not the wait for the rate limiter.
+        context['rds_alarms_call'] = (model.name, time.monotonic())
+
+    def after_call(self, context, **kwargs):
+        api_name, started = context.pop('rds_alarms_call', (None, None))
+
+        if api_name is not None:
+            run_metrics.record_latency(api_name, time.monotonic() - started)
+
+    # Returns the seconds to wait before retrying, or None to hand the response (or error) back to the caller.
+    def needs_retry(self, account_id, region, response, operation, attempts, caught_exception, **kwargs):
+        limiter = self.get_limiter(account_id, region, operation.name)
+
+        if caught_exception is not None:
+            # Connection errors and timeouts, anything else is a bug and goes straight back.
+            if not isinstance(caught_exception, (HTTPClientError, BotocoreConnectionError)):
+                return None
+        else:
+            http_response, parsed = response
+            error_code = parsed.get('Error', {}).get('Code')
+
+            if error_code in THROTTLING_ERROR_CODES or http_response.status_code == 429:
+                limiter.on_throttle()
+                run_metrics.count_api(operation.name, 'throttles')
+            elif error_code in TRANSIENT_ERROR_CODES or http_response.status_code in TRANSIENT_STATUS_CODES:
+                pass
+            else:
+                if http_response.status_code < 300:
+                    limiter.on_success()
+                return None
+
+        if attempts >= MAX_ATTEMPTS:
+            log(logging.WARNING, "Giving up on API call", api=operation.name, account=account_id, region=region,
+                attempts=attempts)
+            run_metrics.count_api(operation.name, 'failures')
+            return None
+
+        run_metrics.count_api(operation.name, 'retries')
+
+        # Full jitter, then wait for the (now slower) limiter so retries don't jump the queue.
+        time.sleep(random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts)))
+        limiter.acquire()
+
+        return 0
+
+
+# Assumed role credentials keyed by (account, role). Lives at module level so warm Lambda invocations
+# skip sts.assume_role while the credentials are still good for a full run.
+class CredentialCache:
+
+    def __init__(self, refresh_margin=CREDENTIAL_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self.credentials = {}
+        self.lock = threading.Lock()
+
+    def get(self, account_id, role_name):
+        with self.lock:
+            credentials = self.credentials.get((account_id, role_name))
+
+        if credentials is None:
+            return None
+
+        if credentials['Expiration'] - datetime.now(timezone.utc) <= self.refresh_margin:
+            log(logging.DEBUG, "Cached credentials expire soon, refreshing", account=account_id, role=role_name)
+            return None
+
+        return credentials
+
+    def put(self, account_id, role_name, credentials):
+        with self.lock:
+            self.credentials[(account_id, role_name)] = credentials
+
+
+# Instrumentation for one invocation: how long each stage took, summed over every worker, and per-API call,
+# throttle, retry and failure counts with a latency histogram. Reset at the start of each invocation.
+class RunMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.stages = {}
+            self.apis = {}
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+
+            with self.lock:
+                stage_metrics = self.stages.get(stage)
+                if stage_metrics is None:
+                    stage_metrics = self.stages[stage] = {'count': 0, 'seconds': 0.0}
+                stage_metrics['count'] += 1
+                stage_metrics['seconds'] += elapsed
+
+    def get_api_metrics(self, api_name):
+        api_metrics = self.apis.get(api_name)
+
+        if api_metrics is None:
+            api_metrics = self.apis[api_name] = {'calls': 0, 'throttles': 0, 'retries': 0, 'failures': 0,
+                                                 'seconds': 0.0, 'latency': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+        return api_metrics
+
+    def count_api(self, api_name, counter):
+        with self.lock:
+            self.get_api_metrics(api_name)[counter] += 1
+
+    def record_latency(self, api_name, seconds):
+        latency_ms = seconds * 1000
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_MS) and latency_ms > LATENCY_BUCKETS_MS[bucket]:
+            bucket += 1
+
+        with self.lock:
+            api_metrics = self.get_api_metrics(api_name)
+            api_metrics['seconds'] += seconds
+            api_metrics['latency'][bucket] += 1
+
+    def get_report(self):
+        bucket_names = ["<={0}ms".format(bound) for bound in LATENCY_BUCKETS_MS]
+        bucket_names.append(">{0}ms".format(LATENCY_BUCKETS_MS[-1]))
+
+        with self.lock:
+            stages = {stage: {'count': stage_metrics['count'], 'totalMs': round(stage_metrics['seconds'] * 1000)}
+                      for stage, stage_metrics in self.stages.items()}
+
+            apis = {}
+            for api_name, api_metrics in self.apis.items():
+                apis[api_name] = {
+                    'calls': api_metrics['calls'],
+                    'throttles': api_metrics['throttles'],
+                    'retries': api_metrics['retries'],
+                    'failures': api_metrics['failures'],
+                    'totalMs': round(api_metrics['seconds'] * 1000),
+                    'latency': {name: count for name, count in zip(bucket_names, api_metrics['latency']) if count}
+                }
+
+            return {
+                'durationMs': round((time.monotonic() - self.started) * 1000),
+                'stages': stages,
+                'apis': apis
+            }
+
+
+# Writes the run report as CloudWatch Embedded Metric Format, one JSON line per metric group, straight to stdout.
+# The Lambda log handler prefixes every line it logs, which CloudWatch wouldn't recognise as EMF.
+def write_emf_metrics(report, namespace):
+    timestamp = int(time.time() * 1000)
+
+    def emf_line(dimensions, values, unit):
+        line = {
+            '_aws': {
+                'Timestamp': timestamp,
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace,
+                    'Dimensions': [list(dimensions.keys())],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name in values]
+                }]
+            }
+        }
+        line.update(dimensions)
+        line.update(values)
+        print(json.dumps(line))
+
+    emf_line({}, {key: report[key] for key in ('pairs', 'failed', 'dbInstances', 'dbInstancesSkipped',
+                                               'alarmsWritten')}, 'Count')
+    emf_line({}, {'RunDuration': report['durationMs']}, 'Milliseconds')
+
+    for stage, stage_metrics in report['stages'].items():
+        emf_line({'Stage': stage}, {'StageDuration': stage_metrics['totalMs']}, 'Milliseconds')
+
+    for api_name, api_metrics in report['apis'].items():
+        emf_line({'Api': api_name}, {key: api_metrics[key] for key in ('calls', 'throttles', 'retries', 'failures')},
+                 'Count')
+
+
+client_registry = ClientRegistry()
+credential_cache = CredentialCache()
+api_throttle = ApiThrottle()
+run_metrics = RunMetrics()
+
+# Lambda initialisation runs at full CPU and before any event is waiting, so do the model loading there.
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    client_registry.preload(PRELOAD_SERVICES)
+ 
+ 
+def get_all_db_instances(credentials, region, account_id, complete=False):
+    all_db_instances = []
+
+    for db_instances in iter_db_instance_pages(credentials, region, account_id, complete):
+        all_db_instances += db_instances
+
+    log(logging.DEBUG, "We have all DB Instances", region=region, count=len(all_db_instances))
+
+    return all_db_instances
+
+
+# Yields a list of DbInstance objects for each page of describe_db_instances (up to 100 instances a page),
+# so callers can start on the first page before the rest are fetched. An unexpected response ends the listing
+# early, or with complete raises, for callers that can't work from a partial listing.
+def iter_db_instance_pages(credentials, region, account_id, complete=False):
+    log(logging.DEBUG, "get_db_instances", account=account_id, region=region)
+
+    rds_client = get_rds_client(credentials, region, account_id)
+    paginator = rds_client.get_paginator('describe_db_instances')
+    pages = iter(paginator.paginate())
+    tagging_cache = {}
+
+    while True:
+        with run_metrics.timer('rds_list'):
+            response = next(pages, None)
+
+        if response is None:
+            return
+
+        if response['ResponseMetadata']['HTTPStatusCode'] != HTTP_OK:
+            if complete:
+                raise Exception("Unexpected describe_db_instances response: {0}".format(
+                    response['ResponseMetadata']['HTTPStatusCode']))
+            log(logging.WARNING, "Unexpected describe_db_instances response", region=region,
+                http_code=response['ResponseMetadata']['HTTPStatusCode'])
+            return
+
+        log(logging.DEBUG, "describe_db_instances returned HTTP_OK 200", count=len(response['DBInstances']))
+
+        yield get_db_instance_list(credentials, region, account_id, response['DBInstances'], tagging_cache)
+
+
+# A single page of describe_db_instances starting at marker (None for the first page), as a list of DbInstance
+# objects and the marker of the next page, or None if this is the last one.
+def get_db_instance_page(credentials, region, account_id, marker=None, tagging_cache=None):
+    rds_client = get_rds_client(credentials, region, account_id)
+    params = {} if marker is None else {'Marker': marker}
+
+    with run_metrics.timer('rds_list'):
+        response = rds_client.describe_db_instances(**params)
+
+    if response['ResponseMetadata']['HTTPStatusCode'] != HTTP_OK:
+        raise Exception("Unexpected describe_db_instances response: {0}".format(
+            response['ResponseMetadata']['HTTPStatusCode']))
+
+    db_instances = get_db_instance_list(credentials, region, account_id, response['DBInstances'], tagging_cache)
+
+    return db_instances, response.get('Marker')
+
+
+# DbInstance objects for a page of describe_db_instances items.
+def get_db_instance_list(credentials, region, account_id, db_list, tagging_cache=None):
+    # Resolve the tags of every instance on the page up front so the loop below makes no API calls.
+    with run_metrics.timer('tags'):
+        tag_lists = get_all_db_tags(credentials, region, account_id, db_list, tagging_cache)
+
+    # Prepare a collection of DbInstance objects.
+    db_instances = []
+
+    for db in db_list:
+        tag_list = tag_lists.get(db['DBInstanceArn'], [])
+
+        db_instance = DbInstance(db['DBInstanceIdentifier'], db['Engine'], db['AllocatedStorage'], tag_list)
+
+        db_instances.append(db_instance)
+
+    return db_instances
+
+
+# Returns a dict of DBInstanceArn to TagList for the given describe_db_instances items.
+# describe_db_instances already includes a TagList for each instance, so normally there's nothing to look up.
+# If it's missing, ask the Resource Groups Tagging API for every tagged rds:db in the region (one paginated call),
+# and if that isn't allowed in this account fall back to list_tags_for_resource per instance, run concurrently.
+# Pass the same tagging_cache dict for every page of a region so the tagging API is only asked once.
+def get_all_db_tags(credentials, region, account_id, db_list, tagging_cache=None):
+    tag_lists = {}
+    missing_arns = []
+
+    for db in db_list:
+        if 'TagList' in db:
+            tag_lists[db['DBInstanceArn']] = db['TagList']
+        else:
+            missing_arns.append(db['DBInstanceArn'])
+
+    if not any(missing_arns):
+        return tag_lists
+
+    log(logging.DEBUG, "db_instances have no TagList, looking up their tags", region=region, count=len(missing_arns))
+
+    if tagging_cache is None:
+        tagging_cache = {}
+
+    if 'region_tags' not in tagging_cache:
+        try:
+            tagging_cache['region_tags'] = get_tagged_db_resources(credentials, region, account_id)
+        except ClientError as e:
+            log(logging.WARNING, "Resource Groups Tagging API unavailable, looking up tags per instance",
+                account=account_id, region=region, error=e.response['Error']['Code'])
+            tagging_cache['region_tags'] = None
+
+    region_tags = tagging_cache['region_tags']
+
+    if region_tags is not None:
+        # The tagging API only returns resources that have tags, anything else has none.
+        for db_arn in missing_arns:
+            tag_lists[db_arn] = region_tags.get(db_arn, [])
+    else:
+        with ThreadPoolExecutor(max_workers=min(TAG_LOOKUP_CONCURRENCY, len(missing_arns))) as executor:
+            results = executor.map(lambda db_arn: get_db_tags(credentials, region, account_id, db_arn), missing_arns)
+
+            for db_arn, tag_list in zip(missing_arns, results):
+                tag_lists[db_arn] = tag_list
+
+    return tag_lists
+
+
+# Every tagged DB instance in the region from the Resource Groups Tagging API, as a dict of ARN to TagList.
+def get_tagged_db_resources(credentials, region, account_id):
+    tagging_client = client_registry.get_client('resourcegroupstaggingapi', account_id, region, credentials)
+    region_tags = {}
+
+    paginator = tagging_client.get_paginator('get_resources')
+    for page in paginator.paginate(ResourceTypeFilters=['rds:db']):
+        for resource in page['ResourceTagMappingList']:
+            region_tags[resource['ResourceARN']] = resource['Tags']
+
+    return region_tags
+
+
+# A single DB instance by identifier, or None if it doesn't exist or is being deleted.
+# Tags come from the TagList, or list_tags_for_resource for just this instance if there isn't one.
+def get_db_instance(credentials, region, account_id, identifier):
+    rds_client = get_rds_client(credentials, region, account_id)
+
+    try:
+        with run_metrics.timer('rds_list'):
+            response = rds_client.describe_db_instances(DBInstanceIdentifier=identifier)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'DBInstanceNotFound':
+            return None
+        raise
+
+    for db in response['DBInstances']:
+        if db.get('DBInstanceStatus') == 'deleting':
+            return None
+
+        if 'TagList' in db:
+            tag_list = db['TagList']
+        else:
+            with run_metrics.timer('tags'):
+                tag_list = get_db_tags(credentials, region, account_id, db['DBInstanceArn'])
+
+        return DbInstance(db['DBInstanceIdentifier'], db['Engine'], db['AllocatedStorage'], tag_list)
+
+    return None
+
+
+def get_db_tags(credentials, region, account_id, db_arn):
     tag_list = [] 
  
-    rds_client = get_rds_client(credentials, region) 
+    rds_client = get_rds_client(credentials, region, account_id)
  
     response = rds_client.list_tags_for_resource(ResourceName=db_arn) 
  
@@ -155,244 +1241,746 @@ def get_db_tags(credentials, region, db_arn):
     return tag_list 
  
  
-# DBInstance class, this lets us only store the information we need about each instance. 
-class DbInstance: 
- 
-    def __init__(self, instance_identifier, engine, allocated_storage, tag_list): 
- 
-        # convert it all to lowercase strings. 
-        self.instance_identifier = str(instance_identifier).lower() 
-        self.engine = str(engine).lower() 
-        self.allocated_storage = str(allocated_storage).lower() 
-        # default to Dev in case we cant get this from Tags. 
-        self.environment = "dev" 
-        self.translate_tags(tag_list) 
- 
-        print("-- Initialised DbInstance object, identifier: {0}, environment: {1}, engine: {2}, allocated_storage: {3}" 
-              .format(self.instance_identifier, self.environment, self.engine, self.allocated_storage, )) 
- 
-        self.alarms = [] 
- 
+# DBInstance class, this lets us only store the information we need about each instance.
+# Slotted because a large fleet means one of these per instance.
+class DbInstance:
+
+    __slots__ = ('instance_identifier', 'engine', 'allocated_storage', 'environment', 'alarms', 'alarm_configs')
+
+    def __init__(self, instance_identifier, engine, allocated_storage, tag_list):
+
+        # convert it all to lowercase strings, allocated storage is in GB.
+        self.instance_identifier = str(instance_identifier).lower()
+        self.engine = str(engine).lower()
+        self.allocated_storage = int(allocated_storage)
+        # default to Dev in case we cant get this from Tags.
+        self.environment = "dev"
+        self.translate_tags(tag_list)
+
+        log(logging.DEBUG, "Initialised DbInstance object", identifier=self.instance_identifier,
+            environment=self.environment, engine=self.engine, allocated_storage=self.allocated_storage)
+
+        self.alarms = []
+        self.alarm_configs = []
+
     def translate_tags(self, tag_list): 
  
         # check list is not empty: 
         if any(tag_list): 
             for tag in tag_list: 
                 if tag['Key'] == 'Environment': 
-                    # print("Environment tag exists with value: " + tag['Value']) 
                     self.environment = tag["Value"] 
                     self.environment = self.environment.lower() 
         else: 
-            print("### Did not find Environment Tag, default is dev ### ") 
- 
- 
-class AwsAlarmTools: 
- 
-    def __init__(self, all_alarms_config, credentials, region): 
-        self.all_alarms_config = all_alarms_config 
-        self.client = boto3.client('cloudwatch', aws_access_key_id=credentials['AccessKeyId'], 
-                                   aws_secret_access_key=credentials['SecretAccessKey'], 
-                                   aws_session_token=credentials['SessionToken'], 
-                                   region_name=region) 
- 
-    # Given a config, creates the alarm if it doesn't exist. If it does, updates the existing alarm with new values. 
-    def create_alarm(self, config, namespace): 
- 
-        try: 
-            exists_response = self.alarm_exists(config.name) 
- 
-            if "MetricAlarms" in exists_response.keys() and any(exists_response['MetricAlarms']): 
-                print("- Found existing alarm. Updating settings") 
-            else: 
-                print("No existing alarm found.") 
-                print("- Creating new alarm. Metric: {0}, Threshold: {1}, EvalPeriod: {2}" 
-                      .format(config.metric_name, config.threshold, config.evaluation_period)) 
- 
-            response = self.client.put_metric_alarm( 
-                AlarmName=config.name, 
-                ComparisonOperator=config.comparison_operator, 
-                DatapointsToAlarm=config.datapoints_to_alarm, 
-                EvaluationPeriods=config.evaluation_period, 
-                MetricName=config.metric_name, 
-                Namespace=namespace, 
-                Period=config.period, 
-                Statistic='Average', 
-                Threshold=config.threshold, 
-                ActionsEnabled=True, 
-                AlarmActions=config.alarm_action, 
-                AlarmDescription=config.description, 
-                Dimensions=config.dimensions, 
-                Unit=config.unit 
-            ) 
- 
-            if response['ResponseMetadata']['HTTPStatusCode'] != HTTP_OK: 
-                print( 
-                    "Unexpected response in alarm_exists HTTP CODE: " + response['ResponseMetadata']['HTTPStatusCode']) 
-            else: 
-                print("-- Done Alarm {0} HTTP-OK".format(config.name)) 
- 
-        except ClientError as e: 
-            print("Unexpected client error create_alarm: failed to create: {0} error: {1}" 
-                  .format(config.name, e.response)) 
- 
-    def alarm_exists(self, alarm_name): 
- 
-        print("checking if alarm exists " + alarm_name) 
- 
-        # see if we can find an existing alarm. 
-        response = self.client.describe_alarms(AlarmNames=[alarm_name]) 
- 
-        if response['ResponseMetadata']['HTTPStatusCode'] != HTTP_OK: 
-            print("Unexpected response in alarm_exists HTTP CODE: " + response['ResponseMetadata']['HTTPStatusCode']) 
- 
-        return response 
- 
-    # Given a db instance, get the relevant alarm configs this db instance will need. 
-    def get_all_rds_alarm_configs(self, db_instance, sns_arn): 
- 
-        alarms = [] 
-        environment = db_instance.environment 
-        identifier = db_instance.instance_identifier 
-        allocated_storage = db_instance.allocated_storage 
- 
-        alarms.append(self.get_alarm_config("rds-cpu", identifier, environment, allocated_storage, sns_arn)) 
- 
-        # Aurora is a special case, we only need CPU alarms. 
-        if AURORA in db_instance.engine: 
-            return alarms 
- 
-        alarms.append(self.get_alarm_config("rds-storage", identifier, environment, allocated_storage, sns_arn)) 
- 
-        alarms.append(self.get_alarm_config("rds-queuelength", identifier, environment, allocated_storage, sns_arn)) 
- 
-        return alarms 
- 
-    # Simple factory: Gets the required config and handles any shared properties like Description and Dimension. 
-    # Logic for calculating each type of alarm is handled in separate functions. 
-    # I've separated this in-case we need to extend to more use cases. 
-    def get_alarm_config(self, alarm_type, instance_identifier, environment, allocated_storage, sns_arn): 
- 
-        config = "" 
-        if alarm_type == 'rds-cpu': 
-            config = self.get_cpu_alarm_config(environment, instance_identifier) 
-        elif alarm_type == 'rds-storage': 
-            config = self.get_storage_alarm_config(environment, instance_identifier, allocated_storage) 
-        elif alarm_type == 'rds-queuelength': 
-            config = self.get_queue_length_alarm_config(environment, instance_identifier, allocated_storage) 
-        else: 
-            raise ValueError(alarm_type) 
- 
-        config.dimensions = [ 
-            { 
-                'Name': 'DBInstanceIdentifier', 
-                'Value': config.instance_identifier 
-            }, 
-        ] 
- 
-        # Default period is 5 min. 
-        config.period = 300 
- 
-        config.alarm_action = [ 
-            sns_arn, 
-        ] 
- 
-        config.description = "{0} {1} {2} for {3} DataPoints".format(config.metric_name, config.comparison_operator, 
-                                                                     config.threshold_desc, config.datapoints_to_alarm) 
- 
-        # We need to guarantee Int's for these values 
-        try: 
-            config.threshold = int(config.threshold) 
-            config.evaluation_period = int(config.evaluation_period) 
-            config.datapoints_to_alarm = int(config.datapoints_to_alarm) 
-        except ValueError: 
-            print( 
-                "Invalid value for threshold: {0} or evaluation_period: {1} or datapoints_to_alarm{3}. DBInstance: {2}".format( 
-                    config.treshold, 
-                    config.evaluation_period, 
-                    config.instance_identifier), 
-                config.datapoints_to_alarm) 
- 
-            return 
- 
-        return config 
- 
-    def get_cpu_alarm_config(self, environment, instance_identifier): 
- 
-        if environment == "live" or environment == "liveb": 
-            config = Alarm(self.all_alarms_config['liveCpuAlarm']) 
-        else: 
-            config = Alarm(self.all_alarms_config['testCpuAlarm']) 
- 
-        config.instance_identifier = instance_identifier 
-        config.name = "aws-rds-" + instance_identifier + "-High-CPU-Utilization" 
-        config.metric_name = "CPUUtilization" 
-        config.threshold_desc = str(config.threshold) + "%" 
-        config.unit = "Percent" 
- 
-        return config 
- 
-    def get_storage_alarm_config(self, environment, instance_identifier, allocated_storage): 
- 
-        if environment == "live" or environment == "liveb": 
-            config = Alarm(self.all_alarms_config['liveStorageAlarm']) 
-        else: 
-            config = Alarm(self.all_alarms_config['testStorageAlarm']) 
- 
-        config.instance_identifier = instance_identifier 
-        config.name = "aws-rds-" + instance_identifier + "-Low-FreeStorageSpace" 
-        config.metric_name = "FreeStorageSpace" 
- 
-        # We want to alarm when the storage reaches (threshold * allocated storage) 
-        # Allocated storage is in GB 
-        config.threshold = int(allocated_storage) * (int(config.threshold) / 100) 
- 
-        # Create a sensible treshold description for the alarm so we dont show a million bytes. 
-        config.threshold_desc = str(config.threshold) + "GB" 
- 
-        # Convert to Bytes, CloudWatch needs this in Bytes. 
-        config.threshold = config.threshold * 1073741824 
-        config.unit = "Bytes" 
- 
-        return config 
- 
-    def get_queue_length_alarm_config(self, environment, instance_identifier, allocated_storage): 
- 
-        if environment == "live" or environment == "liveb": 
-            config = Alarm(self.all_alarms_config['liveQueueLengthAlarm']) 
-        else: 
-            config = Alarm(self.all_alarms_config['testQueueLengthAlarm']) 
- 
-        config.instance_identifier = instance_identifier 
-        config.name = "aws-rds-" + instance_identifier + "-High-DiskQueueDepth" 
-        config.metric_name = "DiskQueueDepth" 
- 
-        allocated_storage = int(allocated_storage) 
- 
-        # queue length treshold = ((3*storage) * (ql_percentage)) 
-        ql_percentage = 0.1 
-        if allocated_storage >= 1000: 
-            ql_percentage = 0.05 
- 
-        config.threshold = (ql_percentage * (3 * allocated_storage)) 
-        config.threshold_desc = str(config.threshold) + " Count" 
-        config.unit = "Count" 
- 
-        return config 
- 
- 
-# Used to de-serialise the data from the alarmConfig json into an object we can work with. 
-class Alarm(object): 
- 
-    def __init__(self, config): 
-        for key in config: 
-            setattr(self, key, config[key]) 
- 
- 
+            log(logging.DEBUG, "Did not find Environment Tag, default is dev", identifier=self.instance_identifier)
+
+
+class AwsAlarmTools:
+
+    def __init__(self, alarm_templates, credentials, region, account_id):
+        self.alarm_templates = alarm_templates
+        self.client = client_registry.get_client('cloudwatch', account_id, region, credentials)
+
+        # Existing alarms keyed by AlarmName, loaded on first use by load_alarm_index.
+        self.alarm_index = None
+        self.alarms_written = 0
+        self.alarms_unchanged = 0
+        self.alarms_failed = 0
+        self.alarms_deleted = 0
+
+    # Reads every existing alarm managed by this tool in one paginated scan, instead of a describe_alarms per alarm.
+    def load_alarm_index(self, prefix=ALARM_NAME_PREFIX):
+        self.alarm_index = {}
+
+        with run_metrics.timer('alarm_index'):
+            paginator = self.client.get_paginator('describe_alarms')
+            for page in paginator.paginate(AlarmNamePrefix=prefix, AlarmTypes=['MetricAlarm']):
+                for alarm in page['MetricAlarms']:
+                    self.alarm_index[alarm['AlarmName']] = alarm
+
+        log(logging.DEBUG, "Loaded existing alarms", prefix=prefix, count=len(self.alarm_index))
+
+        return self.alarm_index
+
+    # Reads just the named alarms into the index, for when only some instances are being reconciled.
+    def load_alarms(self, alarm_names):
+        self.alarm_index = {}
+
+        with run_metrics.timer('alarm_index'):
+            paginator = self.client.get_paginator('describe_alarms')
+            for start in range(0, len(alarm_names), DESCRIBE_ALARMS_BATCH_SIZE):
+                batch = alarm_names[start:start + DESCRIBE_ALARMS_BATCH_SIZE]
+                for page in paginator.paginate(AlarmNames=batch, AlarmTypes=['MetricAlarm']):
+                    for alarm in page['MetricAlarms']:
+                        self.alarm_index[alarm['AlarmName']] = alarm
+
+        return self.alarm_index
+
+    # Given a config, creates the alarm if it doesn't exist. If it does and any setting differs, updates it.
+    # Returns True if put_metric_alarm was called.
+    def create_alarm(self, config, namespace):
+
+        if self.alarm_index is None:
+            self.load_alarm_index()
+
+        alarm_params = get_alarm_params(config, namespace)
+        existing_alarm = self.alarm_index.get(config.name)
+
+        if existing_alarm is None:
+            log(logging.DEBUG, "Creating new alarm", alarm=config.name, metric=config.metric_name,
+                threshold=config.threshold, evaluation_period=config.evaluation_period)
+        elif alarm_differs(existing_alarm, alarm_params):
+            log(logging.DEBUG, "Found existing alarm with different settings, updating", alarm=config.name)
+        else:
+            self.alarms_unchanged += 1
+            return False
+
+        try:
+            with run_metrics.timer('alarm_writes'):
+                response = self.client.put_metric_alarm(**alarm_params)
+
+            if response['ResponseMetadata']['HTTPStatusCode'] != HTTP_OK:
+                log(logging.ERROR, "Unexpected response in create_alarm", alarm=config.name,
+                    http_code=response['ResponseMetadata']['HTTPStatusCode'])
+                self.alarms_failed += 1
+                return False
+
+            log(logging.DEBUG, "Done Alarm HTTP-OK", alarm=config.name)
+
+            # Keep the index current so the same alarm isn't written twice in one run.
+            self.alarm_index[config.name] = alarm_params
+            self.alarms_written += 1
+            return True
+
+        except ClientError as e:
+            log(logging.ERROR, "Unexpected client error create_alarm: failed to create", alarm=config.name,
+                error=e.response['Error'])
+            self.alarms_failed += 1
+            return False
+
+    # Alarms in the index that belong to a DB instance not in live_identifiers. Only names ending in one of our
+    # alarm suffixes count, anything else under the prefix was not made by this tool and is left alone.
+    def get_orphaned_alarm_names(self, live_identifiers):
+        if self.alarm_index is None:
+            self.load_alarm_index()
+
+        orphaned = []
+        for alarm_name in self.alarm_index:
+            identifier = get_alarm_instance_identifier(alarm_name)
+            if identifier is not None and identifier not in live_identifiers:
+                orphaned.append(alarm_name)
+
+        return sorted(orphaned)
+
+    # Deletes alarms with one delete_alarms call per DELETE_ALARMS_BATCH_SIZE names.
+    # A failed batch is logged and the rest carry on. Returns how many alarms were deleted.
+    def delete_alarms(self, alarm_names):
+        deleted_count = 0
+
+        for start in range(0, len(alarm_names), DELETE_ALARMS_BATCH_SIZE):
+            batch = alarm_names[start:start + DELETE_ALARMS_BATCH_SIZE]
+
+            try:
+                with run_metrics.timer('alarm_deletes'):
+                    response = self.client.delete_alarms(AlarmNames=batch)
+            except ClientError as e:
+                log(logging.ERROR, "Unexpected client error delete_alarms", alarms=batch, error=e.response['Error'])
+                continue
+
+            if response['ResponseMetadata']['HTTPStatusCode'] != HTTP_OK:
+                log(logging.ERROR, "Unexpected response in delete_alarms", alarms=batch,
+                    http_code=response['ResponseMetadata']['HTTPStatusCode'])
+                continue
+
+            for alarm_name in batch:
+                self.alarm_index.pop(alarm_name, None)
+            deleted_count += len(batch)
+
+        self.alarms_deleted += deleted_count
+
+        return deleted_count
+
+    # Given a db instance, get the relevant alarm configs this db instance will need.
+    def get_all_rds_alarm_configs(self, db_instance, sns_arn):
+
+        alarms = []
+        templates = self.alarm_templates.for_environment(db_instance.environment)
+        identifier = db_instance.instance_identifier
+        allocated_storage = db_instance.allocated_storage
+
+        # Every alarm of an instance has the same dimensions and actions, they can share the lists.
+        dimensions = [
+            {
+                'Name': 'DBInstanceIdentifier',
+                'Value': identifier
+            },
+        ]
+
+        alarm_action = [
+            sns_arn,
+        ]
+
+        alarms.append(self.get_alarm_config("rds-cpu", templates, identifier, allocated_storage, dimensions,
+                                            alarm_action))
+
+        # Aurora is a special case, we only need CPU alarms.
+        if AURORA in db_instance.engine:
+            return alarms
+
+        alarms.append(self.get_alarm_config("rds-storage", templates, identifier, allocated_storage, dimensions,
+                                            alarm_action))
+
+        alarms.append(self.get_alarm_config("rds-queuelength", templates, identifier, allocated_storage, dimensions,
+                                            alarm_action))
+
+        return alarms
+
+    # Simple factory: picks the compiled template for the alarm type and works out the threshold.
+    # Logic for calculating each type of threshold is handled in separate functions.
+    # I've separated this in-case we need to extend to more use cases.
+    def get_alarm_config(self, alarm_type, templates, instance_identifier, allocated_storage, dimensions,
+                         alarm_action):
+
+        template = templates.get(alarm_type)
+
+        if alarm_type == 'rds-cpu':
+            threshold, threshold_desc = template.threshold, template.threshold_desc
+        elif alarm_type == 'rds-storage':
+            threshold, threshold_desc = self.get_storage_threshold(template, allocated_storage)
+        elif alarm_type == 'rds-queuelength':
+            threshold, threshold_desc = self.get_queue_length_threshold(allocated_storage)
+        else:
+            raise ValueError(alarm_type)
+
+        return Alarm(template, instance_identifier, threshold, threshold_desc, dimensions, alarm_action)
+
+    def get_storage_threshold(self, template, allocated_storage):
+
+        # We want to alarm when the storage reaches (threshold * allocated storage)
+        # Allocated storage is in GB
+        threshold = allocated_storage * template.threshold_ratio
+
+        # Create a sensible treshold description for the alarm so we dont show a million bytes.
+        # Convert to Bytes, CloudWatch needs this in Bytes.
+        return threshold * 1073741824, str(threshold) + "GB"
+
+    def get_queue_length_threshold(self, allocated_storage):
+
+        # queue length treshold = ((3*storage) * (ql_percentage))
+        ql_percentage = 0.1
+        if allocated_storage >= 1000:
+            ql_percentage = 0.05
+
+        threshold = (ql_percentage * (3 * allocated_storage))
+
+        return threshold, str(threshold) + " Count"
+
+
+# The put_metric_alarm arguments for an alarm config.
+def get_alarm_params(config, namespace):
+    return {
+        'AlarmName': config.name,
+        'ComparisonOperator': config.comparison_operator,
+        'DatapointsToAlarm': config.datapoints_to_alarm,
+        'EvaluationPeriods': config.evaluation_period,
+        'MetricName': config.metric_name,
+        'Namespace': namespace,
+        'Period': config.period,
+        'Statistic': 'Average',
+        'Threshold': config.threshold,
+        'ActionsEnabled': True,
+        'AlarmActions': config.alarm_action,
+        'AlarmDescription': config.description,
+        'Dimensions': config.dimensions,
+        'Unit': config.unit
+    }
+
+
+# Compares an alarm from describe_alarms with the put_metric_alarm arguments we want for it.
+def alarm_differs(existing_alarm, alarm_params):
+    for key in ALARM_COMPARE_KEYS:
+        if existing_alarm.get(key) != alarm_params[key]:
+            return True
+
+    if float(existing_alarm.get('Threshold', 0)) != float(alarm_params['Threshold']):
+        return True
+
+    if sorted(existing_alarm.get('AlarmActions', [])) != sorted(alarm_params['AlarmActions']):
+        return True
+
+    existing_dimensions = sorted((d['Name'], d['Value']) for d in existing_alarm.get('Dimensions', []))
+    wanted_dimensions = sorted((d['Name'], d['Value']) for d in alarm_params['Dimensions'])
+
+    return existing_dimensions != wanted_dimensions
+
+
+# The name of every alarm this tool could create for a DB instance.
+def get_alarm_names(instance_identifier):
+    return [ALARM_NAME_PREFIX + instance_identifier + name_suffix for _, _, name_suffix, _, _ in ALARM_TYPES.values()]
+
+
+# The DB instance identifier an alarm name was made for, or None if the name isn't one of ours.
+def get_alarm_instance_identifier(alarm_name):
+    if not alarm_name.startswith(ALARM_NAME_PREFIX):
+        return None
+
+    for _, _, name_suffix, _, _ in ALARM_TYPES.values():
+        if alarm_name.endswith(name_suffix) and len(alarm_name) > len(ALARM_NAME_PREFIX) + len(name_suffix):
+            return alarm_name[len(ALARM_NAME_PREFIX):-len(name_suffix)]
+
+    return None
+
+
+# Builds the orphan collector described by the optional "orphanAlarms" in the event:
+#   {"dryRun": true, "maxDeletes": 500}
+# dryRun only logs what would be deleted. maxDeletes caps the deletes of the whole run, across every pair.
+def get_orphan_collector(orphan_alarms_config):
+    if orphan_alarms_config is None:
+        return None
+
+    max_deletes = orphan_alarms_config.get('maxDeletes', DEFAULT_MAX_ALARM_DELETES)
+
+    try:
+        max_deletes = int(max_deletes)
+    except (TypeError, ValueError):
+        raise Exception("Invalid maxDeletes in Json Input: {0}".format(max_deletes))
+
+    if max_deletes < 0:
+        raise Exception("Invalid maxDeletes in Json Input: {0}".format(max_deletes))
+
+    return OrphanAlarmCollector(bool(orphan_alarms_config.get('dryRun', False)), max_deletes)
+
+
+# Finds and deletes the alarms of DB instances that no longer exist. Shared by every worker so the
+# maxDeletes cap holds for the whole run.
+class OrphanAlarmCollector:
+
+    def __init__(self, dry_run, max_deletes):
+        self.dry_run = dry_run
+        self.deletes_left = max_deletes
+        self.lock = threading.Lock()
+
+    # Takes up to count deletes from what's left of the cap and returns how many were granted.
+    def reserve(self, count):
+        with self.lock:
+            granted = min(count, self.deletes_left)
+            self.deletes_left -= granted
+            return granted
+
+    # Deletes the orphaned alarms of one (account, region). Returns how many orphans were found.
+    def collect(self, alarm_tools, live_identifiers, account_id, region):
+        orphaned = alarm_tools.get_orphaned_alarm_names(live_identifiers)
+
+        if not orphaned:
+            return 0
+
+        if self.dry_run:
+            log(logging.INFO, "Dry run, would delete orphaned alarms", account=account_id, region=region,
+                count=len(orphaned), alarms=orphaned)
+            return len(orphaned)
+
+        granted = self.reserve(len(orphaned))
+        if granted < len(orphaned):
+            log(logging.WARNING, "Orphaned alarm delete cap reached, leaving the rest for the next run",
+                account=account_id, region=region, orphaned=len(orphaned), deleting=granted)
+
+        if granted > 0:
+            deleted_count = alarm_tools.delete_alarms(orphaned[:granted])
+            log(logging.INFO, "Deleted orphaned alarms", account=account_id, region=region, count=deleted_count)
+
+        return len(orphaned)
+
+
+# One entry of the alarmConfig json, validated and converted once per invocation so building the alarms
+# for each DB instance doesn't have to.
+class AlarmTemplate:
+
+    __slots__ = ('alarm_type', 'name_suffix', 'metric_name', 'unit', 'comparison_operator', 'threshold',
+                 'threshold_ratio', 'threshold_desc', 'datapoints_to_alarm', 'evaluation_period', 'period',
+                 'description_prefix', 'description_suffix')
+
+    def __init__(self, alarm_type, config_key, config):
+        _, self.metric_name, self.name_suffix, self.unit, needs_threshold = ALARM_TYPES[alarm_type]
+        self.alarm_type = alarm_type
+
+        if not isinstance(config, dict):
+            raise ValueError("Invalid alarmConfig {0}: expected an object".format(config_key))
+
+        self.comparison_operator = config.get('comparison_operator')
+        if self.comparison_operator not in COMPARISON_OPERATORS:
+            raise ValueError("Invalid alarmConfig {0}: comparison_operator {1!r} must be one of {2}"
+                             .format(config_key, self.comparison_operator, ", ".join(COMPARISON_OPERATORS)))
+
+        self.evaluation_period = get_config_int(config, config_key, 'evaluation_period')
+        self.datapoints_to_alarm = get_config_int(config, config_key, 'datapoints_to_alarm')
+
+        if self.datapoints_to_alarm > self.evaluation_period:
+            raise ValueError("Invalid alarmConfig {0}: datapoints_to_alarm {1} is more than evaluation_period {2}"
+                             .format(config_key, self.datapoints_to_alarm, self.evaluation_period))
+
+        self.threshold = None
+        self.threshold_ratio = None
+        self.threshold_desc = None
+        if needs_threshold:
+            self.threshold = get_config_int(config, config_key, 'threshold')
+            # Storage thresholds are a percentage of the allocated storage.
+            self.threshold_ratio = self.threshold / 100
+            self.threshold_desc = str(self.threshold) + "%"
+
+        # Default period is 5 min.
+        self.period = 300
+
+        # The description is "<metric> <operator> <threshold> for <n> DataPoints", only the threshold varies.
+        self.description_prefix = "{0} {1} ".format(self.metric_name, self.comparison_operator)
+        self.description_suffix = " for {0} DataPoints".format(self.datapoints_to_alarm)
+
+
+# The compiled alarmConfig: a template per alarm type for live and for test environments.
+class AlarmTemplates:
+
+    __slots__ = ('live', 'test', 'by_environment', 'live_fingerprint', 'test_fingerprint')
+
+    def __init__(self, all_alarms_config):
+        if not isinstance(all_alarms_config, dict):
+            raise ValueError("Invalid alarmConfig: expected an object")
+
+        self.live = {}
+        self.test = {}
+
+        for alarm_type, alarm_type_config in ALARM_TYPES.items():
+            config_suffix = alarm_type_config[0]
+
+            for prefix, templates in (('live', self.live), ('test', self.test)):
+                config_key = prefix + config_suffix
+
+                if config_key not in all_alarms_config:
+                    raise ValueError("Invalid alarmConfig: missing {0}".format(config_key))
+
+                templates[alarm_type] = AlarmTemplate(alarm_type, config_key, all_alarms_config[config_key])
+
+        self.by_environment = {environment: self.live for environment in LIVE_ENVIRONMENTS}
+
+        # A change to the live settings only invalidates the fingerprints of live instances, and the same for test.
+        self.live_fingerprint = get_templates_fingerprint(self.live)
+        self.test_fingerprint = get_templates_fingerprint(self.test)
+
+    def for_environment(self, environment):
+        return self.by_environment.get(environment, self.test)
+
+    def fingerprint_for_environment(self, environment):
+        return self.live_fingerprint if environment in LIVE_ENVIRONMENTS else self.test_fingerprint
+
+
+def get_templates_fingerprint(templates):
+    settings = [(alarm_type, template.comparison_operator, template.threshold, template.datapoints_to_alarm,
+                 template.evaluation_period, template.period) for alarm_type, template in sorted(templates.items())]
+
+    return hashlib.sha1(repr(settings).encode('utf-8')).hexdigest()
+
+
+def get_config_int(config, config_key, name):
+    value = config.get(name)
+
+    try:
+        result = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid alarmConfig {0}: {1} {2!r} is not a whole number".format(config_key, name, value))
+
+    if result <= 0:
+        raise ValueError("Invalid alarmConfig {0}: {1} must be more than 0".format(config_key, name))
+
+    return result
+
+
+# A computed alarm for one DB instance, everything put_metric_alarm needs.
+class Alarm:
+
+    __slots__ = ('instance_identifier', 'name', 'metric_name', 'comparison_operator', 'threshold', 'threshold_desc',
+                 'datapoints_to_alarm', 'evaluation_period', 'period', 'unit', 'dimensions', 'alarm_action',
+                 'description')
+
+    def __init__(self, template, instance_identifier, threshold, threshold_desc, dimensions, alarm_action):
+        self.instance_identifier = instance_identifier
+        self.name = ALARM_NAME_PREFIX + instance_identifier + template.name_suffix
+        self.metric_name = template.metric_name
+        self.comparison_operator = template.comparison_operator
+        # CloudWatch gets whole number thresholds, the description keeps the exact value.
+        self.threshold = int(threshold)
+        self.threshold_desc = threshold_desc
+        self.datapoints_to_alarm = template.datapoints_to_alarm
+        self.evaluation_period = template.evaluation_period
+        self.period = template.period
+        self.unit = template.unit
+        self.dimensions = dimensions
+        self.alarm_action = alarm_action
+        self.description = template.description_prefix + threshold_desc + template.description_suffix
+
+
+# Builds the state store described by the optional "stateStore" in the event:
+#   {"type": "sqlite", "path": "/tmp/rds-alarms.db"}
+#   {"type": "json", "path": "/tmp/rds-alarms-state"}   (a directory, one file per account/region)
+#   {"type": "s3", "bucket": "my-bucket", "prefix": "rds-alarms/"}
+# Only S3 outlives the Lambda container, the local stores are for running this script by hand and testing.
+def get_state_store(state_store_config):
+    if state_store_config is None:
+        return None
+
+    store_type = state_store_config.get('type')
+
+    if store_type == 'sqlite':
+        return SqliteStateStore(state_store_config['path'])
+    elif store_type == 'json':
+        return ObjectStateStore(LocalObjects(state_store_config['path']))
+    elif store_type == 's3':
+        return ObjectStateStore(S3Objects(state_store_config['bucket']), state_store_config.get('prefix', ''))
+
+    raise Exception("Invalid stateStore type in Json Input: {0}".format(store_type))
+
+
+# Keeps each (account, region)'s instance fingerprints from the last run as a JSON object.
+class ObjectStateStore:
+
+    def __init__(self, objects, prefix=''):
+        self.objects = objects
+        self.prefix = prefix
+
+    def get_key(self, account_id, region):
+        return "{0}{1}/{2}.json".format(self.prefix, account_id, region)
+
+    def load(self, account_id, region):
+        body = self.objects.get(self.get_key(account_id, region))
+
+        if body is None:
+            return {}
+
+        return json.loads(body)['fingerprints']
+
+    def save(self, account_id, region, fingerprints):
+        body = json.dumps({'fingerprints': fingerprints}, sort_keys=True)
+        self.objects.put(self.get_key(account_id, region), body.encode('utf-8'))
+
+
+# Objects in an S3 bucket, read and written with the Lambda's own role.
+class S3Objects:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def get(self, key):
+        s3 = client_registry.get_client('s3')
+
+        try:
+            return s3.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    def put(self, key, body):
+        client_registry.get_client('s3').put_object(Bucket=self.bucket, Key=key, Body=body,
+                                                    ContentType='application/json')
+
+
+# Stand-in for S3Objects that keeps the objects as files under a local directory.
+class LocalObjects:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as object_file:
+                return object_file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, body):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename, so a run killed half way never leaves a truncated snapshot behind.
+        with open(path + '.tmp', 'wb') as object_file:
+            object_file.write(body)
+        os.replace(path + '.tmp', path)
+
+
+# Keeps the instance fingerprints in a local SQLite database, one row per instance.
+class SqliteStateStore:
+
+    def __init__(self, path):
+        # Shared by the worker threads, the lock keeps them to one statement at a time.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS fingerprints (account TEXT, region TEXT, "
+                                    "identifier TEXT, fingerprint TEXT, PRIMARY KEY (account, region, identifier))")
+
+    def load(self, account_id, region):
+        with self.lock:
+            rows = self.connection.execute("SELECT identifier, fingerprint FROM fingerprints "
+                                           "WHERE account = ? AND region = ?", (account_id, region)).fetchall()
+
+        return dict(rows)
+
+    def save(self, account_id, region, fingerprints):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM fingerprints WHERE account = ? AND region = ?", (account_id, region))
+            self.connection.executemany("INSERT INTO fingerprints VALUES (?, ?, ?, ?)",
+                                        [(account_id, region, identifier, fingerprint)
+                                         for identifier, fingerprint in fingerprints.items()])
+
+
+# Builds the work queue described by the optional "workQueue" in the event. Add "seed": true on the scheduled
+# invocation that starts each sweep, the workers that drain the queue leave it out:
+#   {"type": "sqs", "queueUrl": "https://sqs.ap-southeast-2.amazonaws.com/123456789012/rds-alarms"}
+#   {"type": "sqlite", "path": "/tmp/rds-alarms-queue.db"}
+#   {"type": "local"}   (in memory, lasts as long as the Lambda container)
+# Only SQS outlives the container and can be shared by separate invocations, the others are for running this
+# script by hand and testing.
+def get_work_queue(work_queue_config):
+    if work_queue_config is None:
+        return None
+
+    queue_type = work_queue_config.get('type')
+
+    if queue_type == 'sqs':
+        return SqsWorkQueue(work_queue_config['queueUrl'], work_queue_config.get('region'))
+    elif queue_type == 'sqlite':
+        return SqliteWorkQueue(work_queue_config['path'])
+    elif queue_type == 'local':
+        return local_work_queue
+
+    raise Exception("Invalid workQueue type in Json Input: {0}".format(queue_type))
+
+
+# Every work queue works like SQS: receive() hides an item for WORK_ITEM_VISIBILITY_TIMEOUT seconds and returns
+# (receipt, item), or None if nothing is visible. ack(receipt) removes the item for good.
+class SqsWorkQueue:
+
+    def __init__(self, queue_url, region=None):
+        self.queue_url = queue_url
+        self.client = client_registry.get_client('sqs', region=region)
+
+    def is_empty(self):
+        attributes = self.client.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible',
+                            'ApproximateNumberOfMessagesDelayed'])['Attributes']
+
+        return all(int(count) == 0 for count in attributes.values())
+
+    def put(self, items):
+        # send_message_batch takes up to 10 messages.
+        for start in range(0, len(items), 10):
+            entries = [{'Id': str(number), 'MessageBody': json.dumps(item)}
+                       for number, item in enumerate(items[start:start + 10])]
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+
+            if any(response.get('Failed', [])):
+                raise Exception("Failed to queue work items: {0}".format(response['Failed']))
+
+    def receive(self):
+        # Wait a second for a message so items queued by other workers a moment ago are seen.
+        response = self.client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=1,
+                                               VisibilityTimeout=WORK_ITEM_VISIBILITY_TIMEOUT)
+
+        for message in response.get('Messages', []):
+            return message['ReceiptHandle'], json.loads(message['Body'])
+
+        return None
+
+    def ack(self, receipt):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=receipt)
+
+
+# Stand-in for SqsWorkQueue that keeps the items in a SQLite table, so a sweep can be stopped and resumed locally.
+class SqliteWorkQueue:
+
+    def __init__(self, path):
+        # Shared by the worker threads, the lock keeps them to one statement at a time.
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS work_items (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                    "body TEXT, visible_at REAL, receipt TEXT)")
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM work_items").fetchone()[0] == 0
+
+    def put(self, items):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT INTO work_items (body, visible_at) VALUES (?, 0)",
+                                        [(json.dumps(item),) for item in items])
+
+    def receive(self):
+        receipt = os.urandom(16).hex()
+        now = time.time()
+
+        # A single UPDATE claims the item, so two processes sharing the file can't both get it.
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE work_items SET visible_at = ?, receipt = ? WHERE id = "
+                                    "(SELECT id FROM work_items WHERE visible_at <= ? ORDER BY id LIMIT 1)",
+                                    (now + WORK_ITEM_VISIBILITY_TIMEOUT, receipt, now))
+            row = self.connection.execute("SELECT body FROM work_items WHERE receipt = ?", (receipt,)).fetchone()
+
+        if row is None:
+            return None
+
+        return receipt, json.loads(row[0])
+
+    def ack(self, receipt):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM work_items WHERE receipt = ?", (receipt,))
+
+
+# Stand-in for SqsWorkQueue that keeps the items in memory.
+class LocalWorkQueue:
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def is_empty(self):
+        with self.lock:
+            return not any(self.items)
+
+    def put(self, items):
+        with self.lock:
+            for item in items:
+                self.items[os.urandom(16).hex()] = (0, item)
+
+    def receive(self):
+        now = time.monotonic()
+
+        with self.lock:
+            for receipt, (visible_at, item) in self.items.items():
+                if visible_at <= now:
+                    # A new receipt each time, so a worker that lost the item can't acknowledge it.
+                    del self.items[receipt]
+                    receipt = os.urandom(16).hex()
+                    self.items[receipt] = (now + WORK_ITEM_VISIBILITY_TIMEOUT, item)
+                    return receipt, item
+
+        return None
+
+    def ack(self, receipt):
+        with self.lock:
+            self.items.pop(receipt, None)
+
+
+local_work_queue = LocalWorkQueue()
+
+
 # USED FOR TESTING LOCALLY 
 if __name__ == "__main__": 
     AWS_PROFILE = "kg-training-default" 
     AWS_REGION = 'ap-southeast-2' 
-    boto3.setup_default_session(profile_name=AWS_PROFILE, region_name=AWS_REGION) 
+    client_registry.session = botocore.session.Session(profile=AWS_PROFILE)
+    client_registry.session.set_config_variable('region', AWS_REGION)
+    logging.basicConfig(format="%(message)s")
  
     event = { 
         "roleName": "AWS-RdsAlarmAutomation", 
@@ -402,8 +1990,9 @@ if __name__ == "__main__":
         ], 
         "regions": [ 
             "ap-southeast-2" 
-        ], 
-        "alarmConfig": { 
+        ],
+        "concurrency": 8,
+        "alarmConfig": {
             "liveCpuAlarm": { 
                 "threshold": "85", 
                 "comparison_operator": "GreaterThanThreshold", 
@@ -1,9 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3 
 from botocore.exceptions import ClientError 
 
 rds_client = boto3.client('rds')
 HTTP_OK = 200 
 
+# Concurrent list_tags_for_resource calls when describe_db_instances didn't return a TagList.
+TAG_LOOKUP_CONCURRENCY = 8
+
 def get_all_db_instances(): 
     db_api_response = [] 
     pagination_marker = "" 
@@ -30,8 +35,16 @@ def get_all_db_instances():
     # Prepare a collection of DbInstance objects. 
     all_db_instances = [] 
  
+    # describe_db_instances returns each instance's TagList, only look up the ones that are missing it.
+    missing_arns = [db['DBInstanceArn'] for db in db_api_response if 'TagList' not in db]
+    tag_lists = {}
+
+    if any(missing_arns):
+        with ThreadPoolExecutor(max_workers=min(TAG_LOOKUP_CONCURRENCY, len(missing_arns))) as executor:
+            tag_lists = dict(zip(missing_arns, executor.map(get_db_tags, missing_arns)))
+
     for db in db_api_response: 
-        tag_list = get_db_tags(db['DBInstanceArn']) 
+        tag_list = db['TagList'] if 'TagList' in db else tag_lists[db['DBInstanceArn']]
  
         db_instance = DbInstance(db['DBInstanceIdentifier'], db['Engine'], db['AllocatedStorage'], tag_list) 
  
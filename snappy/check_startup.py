@@ -0,0 +1,110 @@
+# Startup time check for the ec2action CLI.
+#
+# Runs commands that never reach AWS (help and usage errors) in fresh Python processes and fails if the median
+# wall time of any is over the budget, or if the top level --help imported boto3 or botocore. Nothing is sent
+# to AWS.
+#
+#   python check_startup.py --runs 5 --budget-ms 300
+#
+# After `pip install .` in this directory, --installed also runs the ec2action console script setup.py installs.
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Median milliseconds a command may take before the check fails.
+DEFAULT_BUDGET_MS = 300
+
+# Commands timed, with the exit code each should finish with. 2 is click's usage error.
+COMMANDS = [
+    (['--help'], 0),
+    (['ec2', '--help'], 0),
+    (['s3', '--help'], 0),
+    (['provision', '--help'], 0),
+    (['security-groups', '--help'], 0),
+    (['autoscaling', '--help'], 0),
+    (['ec2', 'list', '--no-such-option'], 2),
+]
+
+# Runs in a child process: run the top level --help and print the AWS modules it imported.
+IMPORT_CHECK_SCRIPT = '''
+import sys
+from ec2action.ec2action import cli
+try:
+    cli(['--help'])
+except SystemExit:
+    pass
+print('imported:' + ','.join(sorted({name.split('.')[0] for name in sys.modules} & {'boto3', 'botocore'})))
+'''
+
+
+def get_env():
+    return dict(os.environ, PYTHONPATH=PACKAGE_DIR)
+
+
+def get_installed_env():
+    return {name: value for name, value in os.environ.items() if name != 'PYTHONPATH'}
+
+
+# program is the command that starts the CLI, by default the module in this directory. An installed script
+# runs without PYTHONPATH, so it has to find the installed package.
+def time_command(args, exit_code, program=None):
+    env = get_installed_env() if program else get_env()
+    program = program or [sys.executable, '-m', 'ec2action.ec2action']
+    started = time.perf_counter()
+    result = subprocess.run(program + args, cwd=PACKAGE_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = (time.perf_counter() - started) * 1000
+
+    if result.returncode != exit_code:
+        raise Exception("ec2action {0} exited with {1}, expected {2}".format(
+            ' '.join(args), result.returncode, exit_code))
+    return elapsed
+
+
+def get_help_imports():
+    output = subprocess.run([sys.executable, '-c', IMPORT_CHECK_SCRIPT], cwd=PACKAGE_DIR, env=get_env(),
+                            check=True, capture_output=True, text=True).stdout
+    line = [line for line in output.splitlines() if line.startswith('imported:')][-1]
+    return [name for name in line[len('imported:'):].split(',') if name]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of the ec2action CLI.")
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes to measure per command")
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help="fail if the median time of a command is over this")
+    parser.add_argument('--installed', action='store_true',
+                        help="also run --help through the ec2action script on PATH, as installed by setup.py")
+    args = parser.parse_args()
+
+    over_budget = False
+    for command, exit_code in COMMANDS:
+        median_ms = statistics.median(time_command(command, exit_code) for _ in range(args.runs))
+        print("ec2action {0}: {1:.0f} ms (budget {2:.0f} ms)".format(' '.join(command), median_ms, args.budget_ms))
+        over_budget = over_budget or median_ms > args.budget_ms
+
+    if args.installed:
+        script = shutil.which('ec2action')
+        if not script:
+            raise Exception("no ec2action script on PATH, install it with pip install {0}".format(PACKAGE_DIR))
+        median_ms = statistics.median(time_command(['--help'], 0, [script]) for _ in range(args.runs))
+        print("{0} --help: {1:.0f} ms (budget {2:.0f} ms)".format(script, median_ms, args.budget_ms))
+        over_budget = over_budget or median_ms > args.budget_ms
+
+    imported = get_help_imports()
+    if imported:
+        print("ec2action --help imported {0}".format(', '.join(imported)))
+
+    if over_budget or imported:
+        print("Startup is over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
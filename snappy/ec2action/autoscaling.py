@@ -0,0 +1,172 @@
+import fnmatch
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+
+from ec2action.aws import botocore_exceptions, get_session
+from ec2action.ec2 import REGION_CONCURRENCY, get_batches, get_filters
+
+# describe_auto_scaling_groups takes at most this many group names, and returns at most this many groups a page.
+GROUP_BATCH_SIZE = 100
+
+# Seconds between describe_auto_scaling_groups rounds while waiting for groups to reach their capacity.
+POLL_INTERVAL = 10
+
+# Seconds execute-policy --wait waits for the groups before giving up.
+DEFAULT_WAIT_TIMEOUT = 600
+
+# Instances in these lifecycle states are still on their way in or out of a group.
+CHANGING_STATES = ['Pending', 'Pending:Wait', 'Pending:Proceed', 'Terminating', 'Terminating:Wait',
+                   'Terminating:Proceed']
+
+def get_autoscaling_client(region):
+    return get_session().client('autoscaling', region_name=region)
+
+# Groups by name, either the named ones (GROUP_BATCH_SIZE names a call) or every group matching the tags,
+# which the API filters on server side. A name pattern is matched here, the API has no wildcards.
+def get_groups(client, names=(), pattern=None, tags=()):
+    paginator = client.get_paginator('describe_auto_scaling_groups')
+    args = {'PaginationConfig': {'PageSize': GROUP_BATCH_SIZE}}
+    if tags:
+        args['Filters'] = get_filters(tags=tags)
+
+    if names:
+        pages = (page for batch in get_batches(list(names), GROUP_BATCH_SIZE)
+                 for page in paginator.paginate(AutoScalingGroupNames=batch, **args))
+    else:
+        pages = paginator.paginate(**args)
+
+    groups = {}
+    for page in pages:
+        for group in page['AutoScalingGroups']:
+            if pattern is None or fnmatch.fnmatch(group['AutoScalingGroupName'], pattern):
+                groups[group['AutoScalingGroupName']] = group
+    return groups
+
+# Names of the groups that have a policy called policy_name, from one paginated describe_policies.
+def get_groups_with_policy(client, policy_name):
+    group_names = set()
+    for page in client.get_paginator('describe_policies').paginate(PolicyNames=[policy_name]):
+        group_names.update(p['AutoScalingGroupName'] for p in page['ScalingPolicies'])
+    return group_names
+
+def get_capacity(group):
+    in_service = [i for i in group['Instances'] if i['LifecycleState'] == 'InService']
+    changing = [i for i in group['Instances'] if i['LifecycleState'] in CHANGING_STATES]
+    return len(in_service), len(changing)
+
+# A group is settled once it has its desired number of instances in service and none coming or going.
+def is_settled(group):
+    in_service, changing = get_capacity(group)
+    return in_service == group['DesiredCapacity'] and not changing
+
+# Polls the groups until they have all settled, with one describe_auto_scaling_groups for every
+# GROUP_BATCH_SIZE groups still waited on each round rather than one per group. Returns the groups
+# that had not settled by the timeout or were deleted while we waited.
+def wait_for_groups(client, group_names, timeout):
+    pending = set(group_names)
+    gone = set()
+    deadline = time.time() + timeout
+
+    while pending:
+        groups = get_groups(client, names=sorted(pending))
+        for name, group in groups.items():
+            if is_settled(group):
+                in_service, _ = get_capacity(group)
+                print('{0} has {1} instances in service'.format(name, in_service))
+                pending.discard(name)
+        # A group that was deleted while we waited will never settle.
+        for name in pending - set(groups):
+            print('{0} no longer exists'.format(name))
+            gone.add(name)
+        pending -= gone
+
+        print('{0}/{1} groups settled'.format(len(group_names) - len(pending), len(group_names)))
+        if not pending or time.time() + POLL_INTERVAL > deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+
+    return sorted(pending | gone)
+
+@click.group()
+def autoscaling():
+    "Command for auto scaling groups"
+
+@autoscaling.command('list')
+@click.option('--group', multiple=True, help="Auto scaling group name, can be repeated")
+@click.option('--name', default=None, help="Only groups with names matching this pattern, like 'web-*'")
+@click.option('--tag', multiple=True, help="Only groups with tag Key=Value, can be repeated")
+@click.option('--region', default=None, help="Region, default is the current region")
+def list_groups(group, name, tag, region):
+    "List auto scaling groups and their capacity"
+
+    client = get_autoscaling_client(region or get_session().region_name)
+    try:
+        groups = get_groups(client, group, name, tag)
+    except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+        raise click.ClickException('could not describe auto scaling groups: {0}'.format(e))
+
+    for group_name, g in sorted(groups.items()):
+        in_service, changing = get_capacity(g)
+        print(', '.join((group_name, 'desired={0}'.format(g['DesiredCapacity']), 'min={0}'.format(g['MinSize']),
+                         'max={0}'.format(g['MaxSize']), 'inService={0}'.format(in_service),
+                         'changing={0}'.format(changing))))
+    return
+
+@autoscaling.command('execute-policy')
+@click.argument('policy_name')
+@click.option('--group', multiple=True, help="Auto scaling group name, can be repeated")
+@click.option('--name', default=None, help="Only groups with names matching this pattern, like 'web-*'")
+@click.option('--tag', multiple=True, help="Only groups with tag Key=Value, can be repeated")
+@click.option('--region', default=None, help="Region, default is the current region")
+@click.option('--honor-cooldown', is_flag=True, help="Skip groups still in their cooldown period")
+@click.option('--wait', is_flag=True, help="Wait until every group has its new capacity in service")
+@click.option('--wait-timeout', type=int, default=DEFAULT_WAIT_TIMEOUT, show_default=True,
+              help="Seconds to wait for the groups")
+def execute_policy(policy_name, group, name, tag, region, honor_cooldown, wait, wait_timeout):
+    "Run POLICY_NAME on every matching auto scaling group"
+
+    if not (group or name or tag):
+        raise click.UsageError('pick the groups with --group, --name or --tag')
+
+    client = get_autoscaling_client(region or get_session().region_name)
+    try:
+        groups = get_groups(client, group, name, tag)
+        with_policy = get_groups_with_policy(client, policy_name)
+    except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+        raise click.ClickException('could not describe auto scaling groups: {0}'.format(e))
+
+    group_names = sorted(n for n in groups if n in with_policy)
+    for group_name in sorted(set(groups) - with_policy):
+        print('{0} has no policy called {1}, skipping'.format(group_name, policy_name))
+    if not group_names:
+        raise click.ClickException('no matching group has a policy called {0}'.format(policy_name))
+
+    executed = []
+    failed = 0
+    with ThreadPoolExecutor(max_workers=REGION_CONCURRENCY) as executor:
+        futures = {executor.submit(client.execute_policy, AutoScalingGroupName=group_name, PolicyName=policy_name,
+                                   HonorCooldown=honor_cooldown): group_name
+                   for group_name in group_names}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print('executed {0} on {1}'.format(policy_name, futures[future]))
+                executed.append(futures[future])
+            except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+                print('could not execute {0} on {1}: {2}'.format(policy_name, futures[future], e))
+                failed += 1
+
+    if wait and executed:
+        try:
+            failed += len(wait_for_groups(client, executed, wait_timeout))
+        except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+            raise click.ClickException('could not describe auto scaling groups: {0}'.format(e))
+
+    if failed:
+        raise click.ClickException('{0} groups failed to scale'.format(failed))
+    return
+
+if __name__ == "__main__":
+    autoscaling()
@@ -0,0 +1,27 @@
+import threading
+
+# boto3 and botocore take a few hundred milliseconds to import, so they are only imported once a command
+# actually talks to AWS. --help and usage errors never pay for them.
+
+session = None
+session_lock = threading.Lock()
+
+# The boto3 session every command builds its clients from.
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            import boto3
+            session = boto3.session.Session()
+        return session
+
+# botocore.exceptions, for except clauses. The expression after except is only evaluated when an exception
+# is being matched, by which point botocore has been imported anyway.
+def botocore_exceptions():
+    import botocore.exceptions
+    return botocore.exceptions
+
+# A botocore client Config, imported on first use like everything else from botocore.
+def get_client_config(**kwargs):
+    from botocore.config import Config
+    return Config(**kwargs)
@@ -0,0 +1,360 @@
+import csv
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+
+from ec2action.aws import botocore_exceptions, get_session
+from ec2action.stream import BoundedStream
+
+# stop_instances/start_instances take a list of instance ids, this many go in each call.
+INSTANCE_BATCH_SIZE = 100
+
+# Regions (and waiters) worked on at the same time.
+REGION_CONCURRENCY = 8
+
+# instances list keeps its results this many seconds, unless --cache-ttl says otherwise. 0 turns the cache off.
+DEFAULT_CACHE_TTL = 300
+
+# Where the inventory cache lives, SNAPPY_CACHE_DIR overrides it.
+CACHE_DIR = os.environ.get('SNAPPY_CACHE_DIR',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'snappy'))
+
+# action: (states the instances must be in, API method, waiter, what we print, state after the waiter)
+INSTANCE_ACTIONS = {
+    'stop': (['running'], 'stop_instances', 'instance_stopped', 'stopping', 'stopped'),
+    'start': (['stopped'], 'start_instances', 'instance_running', 'starting', 'running'),
+}
+
+# One ec2 client per region, shared by the worker threads.
+clients = {}
+clients_lock = threading.Lock()
+
+def get_ec2_client(region):
+    with clients_lock:
+        if region not in clients:
+            clients[region] = get_session().client('ec2', region_name=region)
+        return clients[region]
+
+# --all-regions asks EC2 for every region enabled in the account, otherwise --regions or the default region.
+def get_regions(regions, all_regions):
+    if all_regions:
+        response = get_ec2_client(get_session().region_name).describe_regions()
+        return [r['RegionName'] for r in response['Regions']]
+    if regions:
+        return [r.strip() for r in regions.split(',') if r.strip()]
+    return [get_session().region_name]
+
+# describe_instances filters, so EC2 does the filtering. Values of one filter are ORed, filters are ANDed,
+# so several projects go in one tag:Project filter. tags are "Key=Value" strings.
+def get_filters(projects=(), states=(), instance_types=(), tags=()):
+    filters = []
+    if projects:
+        filters.append({'Name': 'tag:Project', 'Values': list(projects)})
+    if states:
+        filters.append({'Name': 'instance-state-name', 'Values': list(states)})
+    if instance_types:
+        filters.append({'Name': 'instance-type', 'Values': list(instance_types)})
+
+    tag_values = {}
+    for tag in tags:
+        key, separator, value = tag.partition('=')
+        if not separator or not key:
+            raise click.BadParameter('tags must look like Key=Value, got {0}'.format(tag))
+        tag_values.setdefault(key, []).append(value)
+    filters += [{'Name': 'tag:' + key, 'Values': values} for key, values in tag_values.items()]
+
+    return filters
+
+# Yields (region, instances) for each page of describe_instances as it arrives, from all the regions
+# listed concurrently. At most REGION_CONCURRENCY pages wait to be printed, so memory stays flat.
+# A region that fails yields (region, error) once instead.
+def iter_instance_pages(regions, filters):
+    stream = BoundedStream(REGION_CONCURRENCY, REGION_CONCURRENCY)
+
+    def list_region(region):
+        try:
+            paginator = get_ec2_client(region).get_paginator('describe_instances')
+            for page in paginator.paginate(Filters=filters):
+                if stream.stopped.is_set():
+                    break
+                stream.put((region, [i for reservation in page['Reservations'] for i in reservation['Instances']]))
+        except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+            stream.put((region, e))
+
+    for region in regions:
+        stream.submit(list_region, region)
+
+    for region, page in stream:
+        yield region, page
+
+def get_instance_row(region, instance):
+    tags = { t['Key']: t['Value'] for t in instance.get('Tags') or [] }
+    return {
+        'id': instance['InstanceId'],
+        'instanceType': instance['InstanceType'],
+        'state': instance['State']['Name'],
+        'project': tags.get('Project', '<no project>'),
+        'region': region,
+        'tags': tags
+    }
+
+# On-disk cache of instances list rows, one JSON Lines file per (profile, region, filters).
+# A file's age is its modification time, so there is nothing else to keep track of.
+class InventoryCache:
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def get_path(self, region, filters):
+        # The same filters in any order are the same entry.
+        key = json.dumps(sorted((f['Name'], sorted(f['Values'])) for f in filters))
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, '{0}_{1}_{2}.jsonl'.format(get_session().profile_name, region, digest))
+
+    # Seconds since the entry was written, or None if there isn't a fresh one.
+    def get_age(self, region, filters):
+        try:
+            age = time.time() - os.path.getmtime(self.get_path(region, filters))
+        except OSError:
+            return None
+        return age if age < self.ttl else None
+
+    def read(self, region, filters):
+        with open(self.get_path(region, filters)) as f:
+            for line in f:
+                yield json.loads(line)
+
+    # Rows are written to a temporary file as they stream past and only become the entry with commit(),
+    # so a listing that fails half way never leaves a partial entry behind.
+    def open_writer(self, region, filters):
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        return CacheWriter(os.fdopen(handle, 'w'), temp_path, self.get_path(region, filters))
+
+    # Drops every entry of the region, whatever its filters. Used after instances change state.
+    def invalidate(self, region):
+        pattern = os.path.join(glob.escape(self.directory), '{0}_{1}_*.jsonl'.format(
+            glob.escape(get_session().profile_name), glob.escape(region)))
+        for path in glob.glob(pattern):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class CacheWriter:
+
+    def __init__(self, f, temp_path, path):
+        self.f = f
+        self.temp_path = temp_path
+        self.path = path
+
+    def write(self, row):
+        self.f.write(json.dumps(row) + '\n')
+
+    def commit(self):
+        self.f.close()
+        os.replace(self.temp_path, self.path)
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.temp_path)
+
+# Ids of the region's instances for the project that are in one of states, filtered server side.
+def get_instance_ids(region, project, states):
+    filters = get_filters(projects=[project] if project else [], states=states)
+
+    instance_ids = []
+    paginator = get_ec2_client(region).get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            instance_ids += [i['InstanceId'] for i in reservation['Instances']]
+    return instance_ids
+
+def get_batches(items, size=INSTANCE_BATCH_SIZE):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+# Stops or starts the project's instances in one region, INSTANCE_BATCH_SIZE per call.
+# One bad instance fails the whole call, so a failed batch is retried an instance at a time.
+# Returns the batches that were changed and the number of instances that failed.
+def change_region_instances(action, region, project):
+    states, method, _, verb, _ = INSTANCE_ACTIONS[action]
+    client = get_ec2_client(region)
+    changed = []
+    failed = 0
+
+    for batch in get_batches(get_instance_ids(region, project, states)):
+        print('{0} {1} instances in {2}..'.format(verb, len(batch), region))
+        try:
+            getattr(client, method)(InstanceIds=batch)
+            changed.append(batch)
+            continue
+        except botocore_exceptions().ClientError as e:
+            print('batch failed in {0}, retrying one at a time: {1}'.format(region, e))
+
+        succeeded = []
+        for instance_id in batch:
+            try:
+                getattr(client, method)(InstanceIds=[instance_id])
+                succeeded.append(instance_id)
+            except botocore_exceptions().ClientError as e:
+                print('could not {0} instance {1}: {2}'.format(action, instance_id, e))
+                failed += 1
+        if succeeded:
+            changed.append(succeeded)
+
+    # Cached listings of the region now show the wrong states.
+    if changed:
+        InventoryCache(CACHE_DIR, 0).invalidate(region)
+
+    return changed, failed
+
+# Runs change_region_instances for every region concurrently, then with wait, the waiter for every
+# changed batch concurrently, printing how many instances have got there so far.
+def change_instances(action, project, regions, all_regions, wait):
+    _, _, waiter_name, _, end_state = INSTANCE_ACTIONS[action]
+    region_batches = []
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=REGION_CONCURRENCY) as executor:
+        futures = {executor.submit(change_region_instances, action, region, project): region
+                   for region in get_regions(regions, all_regions)}
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                changed, region_failed = future.result()
+            except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+                print('could not {0} instances in {1}: {2}'.format(action, region, e))
+                failed += 1
+                continue
+            region_batches += [(region, batch) for batch in changed]
+            failed += region_failed
+
+    total = sum(len(batch) for _, batch in region_batches)
+    print('{0} instances sent {1}'.format(total, action))
+
+    if wait and total:
+        done = 0
+        with ThreadPoolExecutor(max_workers=REGION_CONCURRENCY) as executor:
+            futures = {executor.submit(get_ec2_client(region).get_waiter(waiter_name).wait, InstanceIds=batch): batch
+                       for region, batch in region_batches}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    done += len(futures[future])
+                    print('{0}/{1} instances {2}'.format(done, total, end_state))
+                except botocore_exceptions().WaiterError as e:
+                    print('gave up waiting for {0} instances: {1}'.format(len(futures[future]), e))
+                    failed += len(futures[future])
+
+    if failed:
+        raise click.ClickException('{0} instances or regions failed to {1}'.format(failed, action))
+
+@click.group()
+def instances():
+     """Command for instances"""
+
+@instances.command('list')
+@click.option('--project', multiple=True, help="Ec2 instances for project, can be repeated")
+@click.option('--state', multiple=True, help="Only instances in this state, can be repeated")
+@click.option('--instance-type', multiple=True, help="Only instances of this type, can be repeated")
+@click.option('--tag', multiple=True, help="Only instances with tag Key=Value, can be repeated")
+@click.option('--regions', default=None, help="Comma separated regions, default is the current region")
+@click.option('--all-regions', is_flag=True, help="Every region enabled in the account")
+@click.option('--output', type=click.Choice(['csv', 'jsonl']), default='csv', help="Output format")
+@click.option('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL, show_default=True,
+              help="Seconds to reuse a previous listing for, 0 to always ask EC2")
+@click.option('--refresh', is_flag=True, help="Ignore cached listings and ask EC2 again")
+def list_instances(project, state, instance_type, tag, regions, all_regions, output, cache_ttl, refresh):
+    "List Ec2 Instances"
+
+    filters = get_filters(project, state, instance_type, tag)
+    cache = InventoryCache(CACHE_DIR, cache_ttl)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    failed = []
+
+    def write_row(row):
+        if output == 'jsonl':
+            sys.stdout.write(json.dumps(row) + '\n')
+        else:
+            writer.writerow((row['id'], row['instanceType'], row['state'], row['project'], row['region']))
+
+    # Regions with a fresh cached listing are printed straight from disk, the rest are asked for.
+    regions_to_list = []
+    for region in get_regions(regions, all_regions):
+        age = None if refresh or cache_ttl <= 0 else cache.get_age(region, filters)
+        if age is None:
+            regions_to_list.append(region)
+            continue
+        print('cache hit for {0} ({1:.0f}s old)'.format(region, age), file=sys.stderr)
+        for row in cache.read(region, filters):
+            write_row(row)
+    sys.stdout.flush()
+
+    if not regions_to_list:
+        return
+
+    print('listing {0} from EC2'.format(', '.join(regions_to_list)), file=sys.stderr)
+    cache_writers = {}
+    if cache_ttl > 0:
+        cache_writers = {region: cache.open_writer(region, filters) for region in regions_to_list}
+
+    completed = False
+    try:
+        # Rows go out a page at a time as the regions answer.
+        for region, page in iter_instance_pages(regions_to_list, filters):
+            if isinstance(page, Exception):
+                print('could not list instances in {0}: {1}'.format(region, page), file=sys.stderr)
+                failed.append(region)
+                continue
+
+            for i in page:
+                row = get_instance_row(region, i)
+                write_row(row)
+                if region in cache_writers:
+                    cache_writers[region].write(row)
+            sys.stdout.flush()
+        completed = True
+    finally:
+        for region, cache_writer in cache_writers.items():
+            if region in failed or not completed:
+                cache_writer.discard()
+            else:
+                cache_writer.commit()
+
+    if failed:
+        raise click.ClickException('could not list instances in {0}'.format(', '.join(failed)))
+    return
+
+@instances.command('stop')
+@click.option('--project', default=None, help="Ec2 instances for project")
+@click.option('--regions', default=None, help="Comma separated regions, default is the current region")
+@click.option('--all-regions', is_flag=True, help="Every region enabled in the account")
+@click.option('--wait', is_flag=True, help="Wait until the instances have stopped")
+def stop_instances(project, regions, all_regions, wait):
+    "Stop Ec2 Instances"
+
+    change_instances('stop', project, regions, all_regions, wait)
+    return
+
+@instances.command('start')
+@click.option('--project', default=None, help="Ec2 instances for project")
+@click.option('--regions', default=None, help="Comma separated regions, default is the current region")
+@click.option('--all-regions', is_flag=True, help="Every region enabled in the account")
+@click.option('--wait', is_flag=True, help="Wait until the instances are running")
+def start_instances(project, regions, all_regions, wait):
+    "Start Ec2 Instances"
+
+    change_instances('start', project, regions, all_regions, wait)
+    return
+
+if __name__ == "__main__":
+    instances()
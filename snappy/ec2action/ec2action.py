@@ -0,0 +1,41 @@
+import importlib
+
+import click
+
+# Command groups, each imported only when it's run. Name: (module, group, help shown in the command list).
+LAZY_GROUPS = {
+    'autoscaling': ('ec2action.autoscaling', 'autoscaling', "List and scale auto scaling groups"),
+    'ec2': ('ec2action.ec2', 'instances', "List, stop and start EC2 instances"),
+    'provision': ('ec2action.provision', 'provision', "Launch EC2 instances from a cached AMI"),
+    's3': ('ec2action.webotran', 'cli', "Deploy a website to S3 and list buckets"),
+    'security-groups': ('ec2action.secgroups', 'security_groups', "Reconcile security group ingress rules"),
+}
+
+
+# A click group that imports a subcommand's module the first time that subcommand is looked up. The command
+# list in --help comes from LAZY_GROUPS, so `ec2action --help` doesn't import any of them, and with them boto3.
+class LazyGroup(click.Group):
+
+    def list_commands(self, ctx):
+        return sorted(LAZY_GROUPS)
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in LAZY_GROUPS:
+            return None
+        module_name, group_name, _ = LAZY_GROUPS[cmd_name]
+        return getattr(importlib.import_module(module_name), group_name)
+
+    def format_commands(self, ctx, formatter):
+        rows = [(name, LAZY_GROUPS[name][2]) for name in self.list_commands(ctx)]
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
+
+@click.group(cls=LazyGroup)
+def cli():
+    "ec2action manages EC2 instances and S3 websites"
+    pass
+
+
+if __name__ == '__main__':
+    cli()
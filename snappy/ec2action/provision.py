@@ -0,0 +1,258 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from ec2action.aws import botocore_exceptions, get_session
+from ec2action.ec2 import CACHE_DIR, REGION_CONCURRENCY, InventoryCache, get_batches, get_ec2_client
+
+# Public SSM parameters that always hold the latest AMI id, so nothing has to search the image list.
+AMI_PARAMETERS = {
+    'amazon-linux-2': '/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2',
+    'amazon-linux-2023': '/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-default-x86_64',
+}
+
+DEFAULT_AMI = 'amazon-linux-2'
+
+# Resolved AMI ids are reused this many seconds, unless --ami-cache-ttl says otherwise. 0 turns the cache off.
+DEFAULT_AMI_CACHE_TTL = 86400
+
+# Seconds between describe_instances rounds while waiting for launched instances.
+POLL_INTERVAL = 5
+
+# Seconds launch --wait waits for the instances to be running before giving up.
+DEFAULT_WAIT_TIMEOUT = 600
+
+# States a launched instance never comes back from.
+FAILED_STATES = ['shutting-down', 'terminated']
+
+# On-disk cache of resolved AMI ids, one small JSON file per (profile, region, AMI source). Like the
+# instances list cache, an entry's age is its modification time.
+class AmiCache:
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def get_path(self, region, source):
+        digest = hashlib.sha1(json.dumps(source).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.directory, 'ami_{0}_{1}_{2}.json'.format(get_session().profile_name, region, digest))
+
+    # The cached AMI id, or None if there isn't a fresh one.
+    def get(self, region, source):
+        path = self.get_path(region, source)
+        try:
+            if time.time() - os.path.getmtime(path) >= self.ttl:
+                return None
+            with open(path) as f:
+                return json.load(f)['imageId']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, region, source, image_id):
+        os.makedirs(self.directory, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'imageId': image_id, 'source': source}, f)
+        os.replace(temp_path, self.get_path(region, source))
+
+# Newest available image called name (wildcards allowed) owned by owner. EC2 does the filtering, so only the
+# matching images come back rather than every image the owner has published.
+def find_image(region, name, owner):
+    response = get_ec2_client(region).describe_images(
+        Owners=[owner],
+        Filters=[{'Name': 'name', 'Values': [name]}, {'Name': 'state', 'Values': ['available']}])
+    if not response['Images']:
+        raise click.ClickException('no available image called {0} owned by {1} in {2}'.format(name, owner, region))
+    return max(response['Images'], key=lambda image: image['CreationDate'])['ImageId']
+
+# ami is an AMI id, a name from AMI_PARAMETERS, an SSM parameter path or an image name pattern.
+# Anything but an id is looked up at most once per ttl.
+def resolve_ami(region, ami, owner, ttl, refresh=False):
+    if ami.startswith('ami-'):
+        return ami
+
+    source = [ami, owner]
+    cache = AmiCache(CACHE_DIR, ttl)
+    if ttl > 0 and not refresh:
+        image_id = cache.get(region, source)
+        if image_id:
+            return image_id
+
+    parameter = AMI_PARAMETERS.get(ami, ami if ami.startswith('/') else None)
+    try:
+        if parameter:
+            ssm = get_session().client('ssm', region_name=region)
+            image_id = ssm.get_parameter(Name=parameter)['Parameter']['Value']
+        else:
+            image_id = find_image(region, ami, owner)
+    except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+        raise click.ClickException('could not resolve AMI {0}: {1}'.format(ami, e))
+
+    if ttl > 0:
+        cache.put(region, source, image_id)
+    return image_id
+
+def get_run_args(image_id, count, min_count, instance_type, key_name, security_groups, subnet, project):
+    args = {
+        'ImageId': image_id,
+        'MinCount': min_count or count,
+        'MaxCount': count,
+        'InstanceType': instance_type,
+    }
+    if key_name:
+        args['KeyName'] = key_name
+    if security_groups:
+        args['SecurityGroupIds'] = list(security_groups)
+    if subnet:
+        args['SubnetId'] = subnet
+    # Tagged at launch so instances list --project finds them straight away.
+    if project:
+        args['TagSpecifications'] = [{'ResourceType': 'instance', 'Tags': [{'Key': 'Project', 'Value': project}]}]
+    return args
+
+# One describe_instances call for a batch of ids. Right after launch EC2 may not know the ids yet,
+# which just means they are still pending.
+def describe_batch(region, instance_ids):
+    try:
+        response = get_ec2_client(region).describe_instances(InstanceIds=instance_ids)
+    except botocore_exceptions().ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+            return []
+        raise
+    return [i for reservation in response['Reservations'] for i in reservation['Instances']]
+
+# Polls every pending instance each round, INSTANCE_BATCH_SIZE ids per describe_instances and the batches
+# concurrently, instead of a waiter per instance. Returns the running instances and the ids that failed
+# or were still pending at the timeout.
+def wait_for_instances(region, instance_ids, timeout):
+    pending = set(instance_ids)
+    running = []
+    failed = []
+    deadline = time.time() + timeout
+
+    with ThreadPoolExecutor(max_workers=REGION_CONCURRENCY) as executor:
+        while pending:
+            for instances in executor.map(lambda batch: describe_batch(region, batch), get_batches(sorted(pending))):
+                for i in instances:
+                    if i['InstanceId'] not in pending:
+                        continue
+                    state = i['State']['Name']
+                    if state == 'running':
+                        running.append(i)
+                    elif state in FAILED_STATES:
+                        print('instance {0} is {1}'.format(i['InstanceId'], state))
+                        failed.append(i['InstanceId'])
+                    else:
+                        continue
+                    pending.discard(i['InstanceId'])
+
+            print('{0}/{1} instances running'.format(len(running), len(instance_ids)))
+            if not pending:
+                break
+            if time.time() + POLL_INTERVAL > deadline:
+                print('gave up waiting for {0} instances'.format(len(pending)))
+                failed += sorted(pending)
+                break
+            time.sleep(POLL_INTERVAL)
+
+    return running, failed
+
+@click.group()
+def provision():
+    "Command for launching instances"
+
+@provision.command('ami')
+@click.option('--ami', default=DEFAULT_AMI, show_default=True,
+              help="AMI id, {0}, an SSM parameter path or an image name pattern".format(
+                  ', '.join(sorted(AMI_PARAMETERS))))
+@click.option('--owner', default='amazon', show_default=True, help="Owner of the image, for name patterns")
+@click.option('--region', default=None, help="Region, default is the current region")
+@click.option('--ami-cache-ttl', type=int, default=DEFAULT_AMI_CACHE_TTL, show_default=True,
+              help="Seconds to reuse a resolved AMI for, 0 to always look it up")
+@click.option('--refresh', is_flag=True, help="Ignore a cached AMI and look it up again")
+def show_ami(ami, owner, region, ami_cache_ttl, refresh):
+    "Print the AMI id launch would use"
+
+    print(resolve_ami(region or get_session().region_name, ami, owner, ami_cache_ttl, refresh))
+    return
+
+@provision.command('launch')
+@click.option('--count', type=click.IntRange(min=1), default=1, show_default=True, help="Instances to launch")
+@click.option('--min-count', type=click.IntRange(min=1), default=None,
+              help="Launch if at least this many fit, default is all of --count")
+@click.option('--instance-type', default='t2.micro', show_default=True, help="Instance type")
+@click.option('--ami', default=DEFAULT_AMI, show_default=True,
+              help="AMI id, {0}, an SSM parameter path or an image name pattern".format(
+                  ', '.join(sorted(AMI_PARAMETERS))))
+@click.option('--owner', default='amazon', show_default=True, help="Owner of the image, for name patterns")
+@click.option('--key-name', default=None, help="Key pair to log in with")
+@click.option('--security-group', multiple=True, help="Security group id, can be repeated")
+@click.option('--subnet', default=None, help="Subnet id, default is the default VPC")
+@click.option('--project', default=None, help="Project tag for the instances")
+@click.option('--region', default=None, help="Region, default is the current region")
+@click.option('--ami-cache-ttl', type=int, default=DEFAULT_AMI_CACHE_TTL, show_default=True,
+              help="Seconds to reuse a resolved AMI for, 0 to always look it up")
+@click.option('--wait', is_flag=True, help="Wait until the instances are running")
+@click.option('--wait-timeout', type=int, default=DEFAULT_WAIT_TIMEOUT, show_default=True,
+              help="Seconds to wait for the instances")
+@click.option('--dry-run', is_flag=True, help="Ask EC2 whether the launch would work without launching")
+def launch_instances(count, min_count, instance_type, ami, owner, key_name, security_group, subnet, project,
+                     region, ami_cache_ttl, wait, wait_timeout, dry_run):
+    "Launch Ec2 Instances"
+
+    if min_count and min_count > count:
+        raise click.BadParameter('--min-count can not be more than --count')
+
+    region = region or get_session().region_name
+    image_id = resolve_ami(region, ami, owner, ami_cache_ttl)
+    args = get_run_args(image_id, count, min_count, instance_type, key_name, security_group, subnet, project)
+    client = get_ec2_client(region)
+
+    if dry_run:
+        try:
+            client.run_instances(DryRun=True, **args)
+        except botocore_exceptions().ClientError as e:
+            if e.response['Error']['Code'] != 'DryRunOperation':
+                raise click.ClickException(str(e))
+        print('would launch {0} {1} instances of {2} in {3}'.format(count, instance_type, image_id, region))
+        return
+
+    # All the instances in one call. EC2 launches between MinCount and MaxCount or none at all.
+    print('launching {0} {1} instances of {2} in {3}..'.format(count, instance_type, image_id, region))
+    try:
+        response = client.run_instances(**args)
+    except botocore_exceptions().ClientError as e:
+        raise click.ClickException(str(e))
+    instance_ids = [i['InstanceId'] for i in response['Instances']]
+    print('{0} instances launched'.format(len(instance_ids)))
+
+    # Cached listings of the region don't have the new instances.
+    InventoryCache(CACHE_DIR, 0).invalidate(region)
+
+    if not wait:
+        for instance_id in instance_ids:
+            print(instance_id)
+        return
+
+    try:
+        running, failed = wait_for_instances(region, instance_ids, wait_timeout)
+    except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+        # The instances are up whatever happened to the waiting, so say which they are.
+        for instance_id in instance_ids:
+            print(instance_id)
+        raise click.ClickException('launched {0} instances but could not wait for them: {1}'.format(
+            len(instance_ids), e))
+    for i in running:
+        print(' '.join((i['InstanceId'], i.get('PublicDnsName') or '-', i.get('PrivateIpAddress') or '-')))
+
+    if failed:
+        raise click.ClickException('{0} instances did not get to running'.format(len(failed)))
+    return
+
+if __name__ == "__main__":
+    provision()
@@ -0,0 +1,203 @@
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import click
+
+from ec2action.aws import botocore_exceptions, get_session
+from ec2action.ec2 import REGION_CONCURRENCY, get_ec2_client
+
+# Protocol numbers EC2 reports by name.
+PROTOCOL_NAMES = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6', 'all': '-1'}
+
+# EC2 reports an ICMP rule without a type or code as -1, meaning all of them.
+ICMP_PROTOCOLS = ['icmp', 'icmpv6']
+
+# Where a rule lets traffic in from: rules file key, IpPermissions list, key inside each entry of that list.
+RULE_SOURCES = [
+    ('cidr', 'IpRanges', 'CidrIp'),
+    ('cidrV6', 'Ipv6Ranges', 'CidrIpv6'),
+    ('sourceGroup', 'UserIdGroupPairs', 'GroupId'),
+    ('prefixList', 'PrefixListIds', 'PrefixListId'),
+]
+
+# A rule is (protocol, from port, to port, source kind, source), in the form EC2 reports it so rules from the
+# file and from EC2 compare equal. Ports are ints, -1 for any ICMP type or code, and None for all traffic.
+def get_rule(protocol, from_port, to_port, kind, source):
+    protocol = str(protocol).lower()
+    protocol = PROTOCOL_NAMES.get(protocol, protocol)
+    if protocol == '-1':
+        return (protocol, None, None, kind, source)
+    return (protocol, get_port(protocol, from_port), get_port(protocol, to_port), kind, source)
+
+def get_port(protocol, port):
+    if port is None:
+        return -1 if protocol in ICMP_PROTOCOLS else None
+    try:
+        return int(port)
+    except (TypeError, ValueError):
+        raise click.ClickException('ports must be whole numbers, got {0}'.format(port))
+
+# Rules from the rules file entries of one group, with their descriptions. An entry looks like
+# {"protocol": "tcp", "port": 22, "cidr": "10.0.0.0/8"}, with fromPort/toPort instead of port for a range,
+# and cidr, cidrV6, sourceGroup or prefixList holding one source or a list of them.
+def get_desired_rules(group, entries):
+    rules = {}
+    for entry in entries:
+        try:
+            from_port = entry.get('fromPort', entry.get('port'))
+            to_port = entry.get('toPort', from_port)
+            protocol = entry['protocol']
+        except (AttributeError, KeyError):
+            raise click.ClickException('rules for {0} need a protocol: {1}'.format(group, entry))
+
+        sources = [(kind, entry[kind]) for kind, _, _ in RULE_SOURCES if kind in entry]
+        if not sources:
+            raise click.ClickException('rules for {0} need a cidr, cidrV6, sourceGroup or prefixList: {1}'.format(
+                group, entry))
+        for kind, values in sources:
+            for value in values if isinstance(values, list) else [values]:
+                rules[get_rule(protocol, from_port, to_port, kind, value)] = entry.get('description')
+    return rules
+
+# Rules a group has now, flattened out of its IpPermissions.
+def get_current_rules(group):
+    rules = set()
+    for permission in group['IpPermissions']:
+        for kind, list_key, value_key in RULE_SOURCES:
+            for source in permission.get(list_key, []):
+                rules.add(get_rule(permission['IpProtocol'], permission.get('FromPort'), permission.get('ToPort'),
+                                   kind, source[value_key]))
+    return rules
+
+# IpPermissions for authorize/revoke, one entry per rule so any mix of rules goes in a single call.
+def get_permissions(rules, descriptions=None):
+    descriptions = descriptions or {}
+    permissions = []
+    for rule in sorted(rules, key=str):
+        protocol, from_port, to_port, kind, source = rule
+        _, list_key, value_key = next(s for s in RULE_SOURCES if s[0] == kind)
+        entry = {value_key: source}
+        if descriptions.get(rule):
+            entry['Description'] = descriptions[rule]
+
+        permission = {'IpProtocol': protocol, list_key: [entry]}
+        if from_port is not None:
+            permission['FromPort'] = from_port
+            permission['ToPort'] = to_port
+        permissions.append(permission)
+    return permissions
+
+def format_rule(rule):
+    protocol, from_port, to_port, kind, source = rule
+    if protocol == '-1' or from_port == -1:
+        ports = 'all'
+    elif from_port == to_port:
+        ports = str(from_port)
+    else:
+        ports = '{0}-{1}'.format(from_port, to_port)
+    return '{0} {1} from {2}'.format('all' if protocol == '-1' else protocol, ports, source)
+
+# The target groups, keyed by the id or name the rules file used, from describe_security_groups filtered to
+# just those groups. Ids and names can't share a filter, so a file that uses both makes one paginated call each.
+def get_groups(region, keys, vpc_id):
+    vpc_filters = [{'Name': 'vpc-id', 'Values': [vpc_id]}] if vpc_id else []
+    paginator = get_ec2_client(region).get_paginator('describe_security_groups')
+    groups = {}
+
+    for filter_name, group_key, wanted in (('group-id', 'GroupId', [k for k in keys if k.startswith('sg-')]),
+                                           ('group-name', 'GroupName', [k for k in keys if not k.startswith('sg-')])):
+        if not wanted:
+            continue
+        for page in paginator.paginate(Filters=[{'Name': filter_name, 'Values': wanted}] + vpc_filters):
+            for group in page['SecurityGroups']:
+                key = group[group_key]
+                if key in groups:
+                    raise click.ClickException('more than one group is called {0}, use its id or --vpc-id'.format(key))
+                groups[key] = group
+
+    missing = [key for key in keys if key not in groups]
+    if missing:
+        raise click.ClickException('no security group {0} in {1}'.format(', '.join(missing), region))
+    return groups
+
+# Applies one group's changes, at most one authorize and one revoke call. New rules go in first so
+# traffic that is being moved to a different rule is never cut off in between.
+def apply_group_changes(region, group_id, to_authorize, to_revoke, descriptions):
+    client = get_ec2_client(region)
+    if to_authorize:
+        client.authorize_security_group_ingress(GroupId=group_id,
+                                                IpPermissions=get_permissions(to_authorize, descriptions))
+    if to_revoke:
+        client.revoke_security_group_ingress(GroupId=group_id, IpPermissions=get_permissions(to_revoke))
+
+@click.group('security-groups')
+def security_groups():
+    "Command for security groups"
+
+@security_groups.command('apply')
+@click.argument('rules_file', type=click.File('r'))
+@click.option('--region', default=None, help="Region, default is the current region")
+@click.option('--vpc-id', default=None, help="Only groups in this VPC, for groups named rather than given by id")
+@click.option('--revoke/--no-revoke', default=True, show_default=True,
+              help="Revoke ingress rules that are not in the rules file")
+@click.option('--dry-run', is_flag=True, help="Print the changes without making them")
+def apply_rules(rules_file, region, vpc_id, revoke, dry_run):
+    """Make the ingress rules of security groups match RULES_FILE.
+
+    RULES_FILE is JSON mapping group ids or names to lists of rules like
+    {"protocol": "tcp", "port": 22, "cidr": "10.0.0.0/8"}.
+    """
+
+    try:
+        rules_by_group = json.load(rules_file)
+    except ValueError as e:
+        raise click.ClickException('could not read {0}: {1}'.format(rules_file.name, e))
+    if not isinstance(rules_by_group, dict):
+        raise click.ClickException('{0} must map security groups to lists of rules'.format(rules_file.name))
+
+    region = region or get_session().region_name
+    try:
+        groups = get_groups(region, list(rules_by_group), vpc_id)
+    except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+        raise click.ClickException('could not describe security groups: {0}'.format(e))
+
+    # The whole plan is worked out before anything changes.
+    changes = []
+    for key, entries in rules_by_group.items():
+        group = groups[key]
+        desired = get_desired_rules(key, entries)
+        current = get_current_rules(group)
+        to_authorize = set(desired) - current
+        to_revoke = current - set(desired) if revoke else set()
+
+        label = group['GroupId'] if key == group['GroupId'] else '{0} ({1})'.format(group['GroupId'], key)
+        for rule in sorted(to_authorize, key=str):
+            print('{0}: + {1}'.format(label, format_rule(rule)))
+        for rule in sorted(to_revoke, key=str):
+            print('{0}: - {1}'.format(label, format_rule(rule)))
+        if to_authorize or to_revoke:
+            changes.append((group['GroupId'], to_authorize, to_revoke, desired))
+
+    print('{0} groups to change, {1} rules to authorize, {2} to revoke'.format(
+        len(changes), sum(len(c[1]) for c in changes), sum(len(c[2]) for c in changes)))
+    if dry_run or not changes:
+        return
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=REGION_CONCURRENCY) as executor:
+        futures = {executor.submit(apply_group_changes, region, group_id, to_authorize, to_revoke, desired): group_id
+                   for group_id, to_authorize, to_revoke, desired in changes}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print('updated {0}'.format(futures[future]))
+            except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+                print('could not update {0}: {1}'.format(futures[future], e))
+                failed += 1
+
+    if failed:
+        raise click.ClickException('{0} security groups could not be updated'.format(failed))
+    return
+
+if __name__ == "__main__":
+    security_groups()
@@ -0,0 +1,53 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Put by a finished task, never seen by the reader.
+TASK_DONE = object()
+
+
+# Runs listing tasks on a thread pool and hands what they put to one reader, as they put it. At most
+# max_queued items wait to be read, so the tasks wait instead of memory growing with the listing.
+# Tasks catch their own errors and put them as items, an exception that escapes a task is lost.
+class BoundedStream:
+
+    def __init__(self, max_workers, max_queued):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.items = queue.Queue(maxsize=max_queued)
+        # Set once the reader stops reading, tasks should stop listing when they see it.
+        self.stopped = threading.Event()
+        self.running = 0
+
+    def put(self, item):
+        # Give up if the reader has stopped reading, otherwise the task would wait forever.
+        while not self.stopped.is_set():
+            try:
+                self.items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    # Runs function(*args) on the pool. Only the reading thread submits, before or while it reads,
+    # so it always knows how many tasks are still going.
+    def submit(self, function, *args):
+        def run():
+            try:
+                function(*args)
+            finally:
+                self.put(TASK_DONE)
+
+        self.running += 1
+        self.executor.submit(run)
+
+    # Yields every item put until all the submitted tasks have finished.
+    def __iter__(self):
+        try:
+            while self.running:
+                item = self.items.get()
+                if item is TASK_DONE:
+                    self.running -= 1
+                else:
+                    yield item
+        finally:
+            self.stopped.set()
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,503 @@
+import fnmatch
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from itertools import repeat
+
+import click
+
+from ec2action.aws import botocore_exceptions, get_client_config, get_session
+from ec2action.stream import BoundedStream
+
+# Prefixes listed at the same time by list-buckets-objects.
+LIST_CONCURRENCY = 16
+
+# How many delimiter levels list-buckets-objects walks to find prefixes to list in parallel.
+DEFAULT_SHARD_DEPTH = 1
+
+# Pages waiting to be printed. Listing threads wait when it's full, so memory doesn't grow with the bucket.
+MAX_QUEUED_PAGES = LIST_CONCURRENCY * 2
+
+# Running totals go to stderr every this many objects.
+PROGRESS_EVERY = 100000
+
+# Buckets looked up at the same time by list-buckets --details.
+BUCKET_CONCURRENCY = 32
+
+# Files at least this big are uploaded in parts of this size. Their ETag is then the MD5 of the part MD5s
+# followed by -<parts>, which sync works out the same way to compare.
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Files synced at the same time, and parts of one file uploaded at the same time.
+UPLOAD_CONCURRENCY = 8
+TRANSFER_CONCURRENCY = 4
+
+# delete_objects takes up to 1000 keys per call.
+DELETE_BATCH_SIZE = 1000
+
+# Files are hashed this many bytes at a time, never read into memory whole.
+HASH_READ_SIZE = 1024 * 1024
+
+# Part sizes (MB) other tools commonly upload with, tried when a multipart ETag doesn't have as many parts
+# as MULTIPART_CHUNK_SIZE would give.
+COMMON_PART_SIZES_MB = (5, 8, 15, 16, 32, 64, 100, 128, 256, 512)
+
+# Content types sync --compress precompresses. Everything else (images, fonts, archives) is compressed already.
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json',
+                      'image/svg+xml')
+
+# Compressed copies are kept here named by the source's SHA-256, so unchanged files aren't compressed again.
+COMPRESSION_CACHE_DIR = os.environ.get(
+    'WEBOTRAN_CACHE_DIR', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                       'webotran', 'compressed'))
+
+# Cache-Control by pattern on the path under the site directory, first match wins. --cache-control rules are
+# checked before these. HTML points at hashed names and has to be checked every time, even when its own name
+# looks hashed (report.3f9a1b2c.html). Any other name whose last part before the extension is a hash, 8 or more
+# hex characters with at least one letter so dates like photo.20231001.jpg don't count, changes whenever its
+# content does, so it can be cached for good.
+DEFAULT_CACHE_CONTROL = (
+    (re.compile(fnmatch.translate('*.html')), 'no-cache'),
+    (re.compile(r'.*\.(?=[0-9]*[a-f])[0-9a-f]{8,}\.[^./]+$'), 'public, max-age=31536000, immutable'),
+)
+
+s3_client = None
+s3_client_lock = threading.Lock()
+region_clients = {}
+
+# One client for every listing and upload thread, with a connection each.
+def get_s3_client():
+    global s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            s3_client = get_session().client(
+                's3', config=get_client_config(max_pool_connections=max(LIST_CONCURRENCY,
+                                                             UPLOAD_CONCURRENCY * TRANSFER_CONCURRENCY)))
+        return s3_client
+
+# Clients per (service, region), so calls about a bucket go straight to the bucket's own region.
+def get_region_client(service, region):
+    with s3_client_lock:
+        if (service, region) not in region_clients:
+            region_clients[(service, region)] = get_session().client(
+                service, region_name=region, config=get_client_config(max_pool_connections=BUCKET_CONCURRENCY))
+        return region_clients[(service, region)]
+
+# Lists the bucket under prefix with one thread per shard and yields each page's objects as it arrives.
+# The first shard_depth levels are listed with the delimiter: objects found there are yielded straight away
+# and every common prefix becomes a shard of its own, which is then listed in full.
+# A shard that fails yields its exception instead, the other shards carry on.
+def iter_object_pages(bucket, prefix='', delimiter='/', shard_depth=DEFAULT_SHARD_DEPTH):
+    client = get_s3_client()
+    stream = BoundedStream(LIST_CONCURRENCY, MAX_QUEUED_PAGES)
+
+    def list_prefix(shard_prefix, depth_left):
+        try:
+            params = {'Bucket': bucket, 'Prefix': shard_prefix}
+            if depth_left > 0:
+                params['Delimiter'] = delimiter
+            for page in client.get_paginator('list_objects_v2').paginate(**params):
+                if stream.stopped.is_set():
+                    break
+                if page.get('Contents'):
+                    stream.put(('objects', page['Contents']))
+                if page.get('CommonPrefixes'):
+                    stream.put(('prefixes', [p['Prefix'] for p in page['CommonPrefixes']], depth_left - 1))
+        except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+            stream.put(('error', e))
+
+    # New shards are submitted from here as their prefixes turn up.
+    stream.submit(list_prefix, prefix, shard_depth)
+    for message in stream:
+        if message[0] == 'prefixes':
+            for shard_prefix in message[1]:
+                stream.submit(list_prefix, shard_prefix, message[2])
+        else:
+            yield message[1]
+
+# Object count and bytes, in total and per storage class.
+class ObjectTotals:
+
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.storage_classes = {}
+
+    def add(self, obj):
+        storage_class = obj.get('StorageClass', 'STANDARD')
+        totals = self.storage_classes.setdefault(storage_class, {'count': 0, 'bytes': 0})
+        totals['count'] += 1
+        totals['bytes'] += obj['Size']
+        self.count += 1
+        self.size += obj['Size']
+
+    def as_dict(self):
+        return {'objects': self.count, 'bytes': self.size, 'storageClasses': self.storage_classes}
+
+# Region, website and optionally size of a bucket, for list-buckets --details.
+def get_bucket_details(name, with_size):
+    details = {'name': name}
+
+    try:
+        # Buckets made before regions had a location constraint report none (us-east-1) or EU.
+        region = get_s3_client().get_bucket_location(Bucket=name).get('LocationConstraint') or 'us-east-1'
+        details['region'] = 'eu-west-1' if region == 'EU' else region
+
+        try:
+            website = get_region_client('s3', details['region']).get_bucket_website(Bucket=name)
+            details['website'] = website.get('IndexDocument', {}).get('Suffix', True)
+        except botocore_exceptions().ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchWebsiteConfiguration':
+                raise
+            details['website'] = None
+
+        if with_size:
+            details['sizeBytes'] = get_bucket_size(name, details['region'])
+    except (botocore_exceptions().BotoCoreError, botocore_exceptions().ClientError) as e:
+        details['error'] = str(e)
+
+    return details
+
+# The bucket's latest daily BucketSizeBytes metric for standard storage, None if there isn't one yet.
+def get_bucket_size(name, region):
+    now = datetime.now(timezone.utc)
+    response = get_region_client('cloudwatch', region).get_metric_statistics(
+        Namespace='AWS/S3', MetricName='BucketSizeBytes',
+        Dimensions=[{'Name': 'BucketName', 'Value': name}, {'Name': 'StorageType', 'Value': 'StandardStorage'}],
+        StartTime=now - timedelta(days=2), EndTime=now, Period=86400, Statistics=['Average'])
+
+    datapoints = sorted(response['Datapoints'], key=lambda datapoint: datapoint['Timestamp'])
+    return int(datapoints[-1]['Average']) if datapoints else None
+
+# The ETag S3 gives a file uploaded in one go (part_size None) or in parts of part_size: the MD5 of the
+# file, or the MD5 of the part MD5s with the number of parts after a dash.
+def get_file_etag(path, part_size=None):
+    whole = hashlib.md5()
+    part_digests = []
+    part = hashlib.md5()
+    part_filled = 0
+    buffer = memoryview(bytearray(HASH_READ_SIZE))
+
+    with open(path, 'rb') as f:
+        while True:
+            # Never read across a part boundary.
+            read_size = HASH_READ_SIZE if part_size is None else min(HASH_READ_SIZE, part_size - part_filled)
+            count = f.readinto(buffer[:read_size])
+            if not count:
+                break
+
+            if part_size is None:
+                whole.update(buffer[:count])
+                continue
+
+            part.update(buffer[:count])
+            part_filled += count
+            if part_filled == part_size:
+                part_digests.append(part.digest())
+                part = hashlib.md5()
+                part_filled = 0
+
+    if part_size is None:
+        return whole.hexdigest()
+
+    if part_filled:
+        part_digests.append(part.digest())
+    return '{0}-{1}'.format(hashlib.md5(b''.join(part_digests)).hexdigest(), len(part_digests))
+
+# True if the object listed for the key already has the local file's content.
+# A different size settles it without reading the file.
+def is_unchanged(path, size, remote):
+    if remote is None or remote['Size'] != size:
+        return False
+
+    etag = remote['ETag'].strip('"')
+    if '-' not in etag:
+        return get_file_etag(path) == etag
+
+    parts = int(etag.split('-')[1])
+    part_sizes = [MULTIPART_CHUNK_SIZE] + [mb * 1024 * 1024 for mb in COMMON_PART_SIZES_MB]
+    for part_size in dict.fromkeys(part_sizes):
+        if -(-size // part_size) == parts and get_file_etag(path, part_size) == etag:
+            return True
+    return False
+
+# (key, path, size) of every file under directory, the key being prefix + its path with / separators.
+def iter_local_files(directory, prefix):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            key = prefix + os.path.relpath(path, directory).replace(os.sep, '/')
+            yield key, path, os.path.getsize(path)
+
+# put_object arguments for a file, the content type going by the name of the original file.
+def get_upload_args(path, cache_control=None, content_encoding=None):
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    upload_args = {'ContentType': content_type}
+    if cache_control:
+        upload_args['CacheControl'] = cache_control
+    if content_encoding:
+        upload_args['ContentEncoding'] = content_encoding
+    return upload_args
+
+# rules are (compiled pattern, Cache-Control) pairs, the first one matching the path decides.
+def get_cache_control(relative_path, rules):
+    for pattern, cache_control in rules:
+        if pattern.match(relative_path):
+            return cache_control
+    return None
+
+# Runs in the compression process pool: returns the path of a copy of path compressed with encoding (gzip or br),
+# compressing only if the cache doesn't have one yet. The gzip header carries no name or time, so the same
+# content always compresses to the same bytes and the same ETag, and sync can tell it's unchanged.
+def compress_file(path, encoding, cache_dir):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_READ_SIZE), b''):
+            digest.update(chunk)
+
+    compressed_path = os.path.join(cache_dir, '{0}.{1}'.format(digest.hexdigest(), encoding))
+    if os.path.exists(compressed_path):
+        return compressed_path
+
+    # Written next to the cache entry and renamed into place, so a half written file is never used.
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with open(path, 'rb') as source, os.fdopen(handle, 'wb') as target:
+        if encoding == 'gzip':
+            with gzip.GzipFile(filename='', mode='wb', fileobj=target, compresslevel=9, mtime=0) as compressed:
+                shutil.copyfileobj(source, compressed, HASH_READ_SIZE)
+        else:
+            import brotli
+            compressor = brotli.Compressor(quality=11)
+            for chunk in iter(lambda: source.read(HASH_READ_SIZE), b''):
+                target.write(compressor.process(chunk))
+            target.write(compressor.finish())
+    os.replace(temp_path, compressed_path)
+
+    return compressed_path
+
+# Compresses every compressible file with encoding in a process pool.
+# Returns a dict of file path to compressed copy, leaving out files that didn't get any smaller.
+def compress_files(paths, encoding):
+    paths = [path for path in paths if mimetypes.guess_type(path)[0] in COMPRESSIBLE_TYPES]
+    compressed = {}
+
+    with ProcessPoolExecutor() as pool:
+        for path, compressed_path in zip(paths, pool.map(compress_file, paths, repeat(encoding),
+                                                         repeat(COMPRESSION_CACHE_DIR), chunksize=16)):
+            if os.path.getsize(compressed_path) < os.path.getsize(path):
+                compressed[path] = compressed_path
+
+    return compressed
+
+# Uploads path to the key unless the remote object already matches. Returns True if it was uploaded.
+def sync_file(bucket, key, path, size, remote, dry_run, upload_args):
+    if is_unchanged(path, size, remote):
+        return False
+
+    if dry_run:
+        print('would upload {0}'.format(key))
+        return True
+
+    from boto3.s3.transfer import TransferConfig
+
+    # Parts at MULTIPART_CHUNK_SIZE so the ETag is one is_unchanged can work out next time.
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_CHUNK_SIZE,
+                                     multipart_chunksize=MULTIPART_CHUNK_SIZE,
+                                     max_concurrency=TRANSFER_CONCURRENCY)
+    get_s3_client().upload_file(path, bucket, key, ExtraArgs=upload_args, Config=transfer_config)
+    print('uploaded {0}'.format(key))
+    return True
+
+# Deletes keys with one delete_objects call per DELETE_BATCH_SIZE. Returns the keys that couldn't be deleted.
+def delete_keys(bucket, keys):
+    failed = []
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start:start + DELETE_BATCH_SIZE]
+        response = get_s3_client().delete_objects(
+            Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        failed += [error['Key'] for error in response.get('Errors', [])]
+    return failed
+
+@click.group()
+def cli():
+    "webotran deploys website to aws"
+    pass
+
+@cli.command('list-buckets')
+@click.option('--details', is_flag=True, help="Also show each bucket's region and website")
+@click.option('--size', is_flag=True, help="Also the size from CloudWatch, implies --details")
+@click.option('--json', 'as_json', is_flag=True, help="One JSON object per bucket, implies --details")
+def list_buckets(details, size, as_json):
+    "List all s3 buckets"
+    if not (details or size or as_json):
+        for buckets in get_session().resource('s3').buckets.all():
+            print (buckets)
+        return
+
+    names = [bucket['Name'] for bucket in get_s3_client().list_buckets()['Buckets']]
+    row_format = '{0:<63} {1:<16} {2:<12} {3:>16}'
+    if not as_json:
+        print(row_format.format('bucket', 'region', 'website', 'size' if size else ''))
+
+    # Every bucket is looked up at once, rows are printed as they come back.
+    errors = 0
+    with ThreadPoolExecutor(max_workers=BUCKET_CONCURRENCY) as executor:
+        futures = [executor.submit(get_bucket_details, name, size) for name in names]
+        for future in as_completed(futures):
+            bucket = future.result()
+            if 'error' in bucket:
+                errors += 1
+            if as_json:
+                print(json.dumps(bucket))
+            elif 'error' in bucket:
+                print(row_format.format(bucket['name'], 'error', '', ''), bucket['error'])
+            else:
+                website = '-' if bucket['website'] is None else str(bucket['website'])
+                bucket_size = bucket.get('sizeBytes')
+                print(row_format.format(bucket['name'], bucket['region'], website,
+                                        '' if bucket_size is None else bucket_size))
+            sys.stdout.flush()
+
+    if errors:
+        raise click.ClickException('{0} buckets could not be looked up'.format(errors))
+
+@cli.command('list-buckets-objects')
+@click.argument('bucket')
+@click.option('--prefix', default='', help="Only keys starting with this")
+@click.option('--delimiter', default='/', show_default=True, help="Splits keys into prefixes to list in parallel")
+@click.option('--shard-depth', type=int, default=DEFAULT_SHARD_DEPTH, show_default=True,
+              help="How many delimiter levels to split the listing by")
+@click.option('--jsonl', is_flag=True, help="One JSON object per key")
+def list_buckets_objects(bucket, prefix, delimiter, shard_depth, jsonl):
+    "List all s3 buckets objects"
+    totals = ObjectTotals()
+    errors = 0
+
+    # Keys come out in the order the shards answer, not sorted.
+    for page in iter_object_pages(bucket, prefix, delimiter, shard_depth):
+        if isinstance(page, Exception):
+            print('could not list part of {0}: {1}'.format(bucket, page), file=sys.stderr)
+            errors += 1
+            continue
+
+        for obj in page:
+            if jsonl:
+                sys.stdout.write(json.dumps({
+                    'key': obj['Key'],
+                    'size': obj['Size'],
+                    'lastModified': obj['LastModified'].isoformat(),
+                    'storageClass': obj.get('StorageClass', 'STANDARD'),
+                    'etag': obj['ETag']
+                }) + '\n')
+            else:
+                sys.stdout.write('{0}\t{1}\t{2}\n'.format(obj['Key'], obj['Size'],
+                                                        obj.get('StorageClass', 'STANDARD')))
+
+            totals.add(obj)
+            if totals.count % PROGRESS_EVERY == 0:
+                print('{0} objects, {1} bytes so far'.format(totals.count, totals.size), file=sys.stderr)
+        sys.stdout.flush()
+
+    print(json.dumps(totals.as_dict()), file=sys.stderr)
+
+    if errors:
+        raise click.ClickException('{0} prefixes of {1} could not be listed'.format(errors, bucket))
+
+@cli.command('sync')
+@click.argument('pathname', type=click.Path(exists=True, file_okay=False))
+@click.argument('bucket')
+@click.option('--prefix', default='', help="Key prefix to sync under")
+@click.option('--delete', is_flag=True, help="Delete keys under the prefix that have no local file")
+@click.option('--dry-run', is_flag=True, help="Only print what would change")
+@click.option('--compress', type=click.Choice(['gzip', 'br']), default=None,
+              help="Precompress HTML, CSS, JS, JSON and SVG and set Content-Encoding")
+@click.option('--cache-control', multiple=True,
+              help="GLOB=VALUE sets Cache-Control for matching paths, can be repeated")
+@click.option('--force', is_flag=True, help="Upload every file, e.g. after changing headers")
+def sync(pathname, bucket, prefix, delete, dry_run, compress, cache_control, force):
+    "Sync PATHNAME to BUCKET, uploading only changed files"
+
+    cache_rules = []
+    for rule in cache_control:
+        pattern, separator, value = rule.partition('=')
+        if not separator or not pattern:
+            raise click.BadParameter('must look like GLOB=VALUE, got {0}'.format(rule), param_hint='--cache-control')
+        cache_rules.append((re.compile(fnmatch.translate(pattern)), value))
+    cache_rules += DEFAULT_CACHE_CONTROL
+
+    if compress == 'br':
+        try:
+            import brotli
+        except ImportError:
+            raise click.ClickException('--compress br needs the brotli package')
+
+    # Size and ETag of everything already there, from the same parallel listing as list-buckets-objects.
+    remote = {}
+    for page in iter_object_pages(bucket, prefix):
+        if isinstance(page, Exception):
+            raise click.ClickException('could not list {0}: {1}'.format(bucket, page))
+        for obj in page:
+            remote[obj['Key']] = {'Size': obj['Size'], 'ETag': obj['ETag']}
+
+    local_files = list(iter_local_files(pathname, prefix))
+    local_keys = set(key for key, _, _ in local_files)
+    uploaded = 0
+    failed = 0
+
+    compressed = {}
+    if compress:
+        compressed = compress_files([path for _, path, _ in local_files], compress)
+
+    # Hashing and uploading both happen on the worker threads. A compressed file is compared and uploaded as
+    # its compressed copy.
+    with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+        futures = {}
+        for key, path, size in local_files:
+            upload_args = get_upload_args(path, get_cache_control(key[len(prefix):], cache_rules),
+                                          compress if path in compressed else None)
+            upload_path = compressed.get(path, path)
+            if upload_path != path:
+                size = os.path.getsize(upload_path)
+            future = executor.submit(sync_file, bucket, key, upload_path, size, None if force else remote.get(key),
+                                     dry_run, upload_args)
+            futures[future] = key
+
+        for future in as_completed(futures):
+            try:
+                uploaded += future.result()
+            except Exception as e:
+                print('could not upload {0}: {1}'.format(futures[future], e), file=sys.stderr)
+                failed += 1
+
+    stale_keys = sorted(set(remote) - local_keys)
+    deleted = 0
+    if delete and stale_keys:
+        if dry_run:
+            for key in stale_keys:
+                print('would delete {0}'.format(key))
+            deleted = len(stale_keys)
+        else:
+            not_deleted = delete_keys(bucket, stale_keys)
+            deleted = len(stale_keys) - len(not_deleted)
+            for key in not_deleted:
+                print('could not delete {0}'.format(key), file=sys.stderr)
+            failed += len(not_deleted)
+
+    print('{0}{1} uploaded, {2} unchanged, {3} deleted'.format('dry run: ' if dry_run else '', uploaded,
+                                                             len(local_keys) - uploaded - failed, deleted))
+
+    if failed:
+        raise click.ClickException('{0} files could not be synced'.format(failed))
+
+if __name__ == "__main__":
+    cli()
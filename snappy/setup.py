@@ -10,10 +10,8 @@ setup(
     install_requires=[
         'click',
         'boto3'
-    ],    entry_points=['''
-        [console_scripts]
-        ec2action=ec2action.ec2action:cli
-        '''
-    ]
-) 
-
+    ],
+    entry_points={
+        'console_scripts': ['ec2action=ec2action.ec2action:cli'],
+    },
+)